@@ -5,6 +5,8 @@ import re
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
+from keystroke import KeySequence, format_keys, keys_sort_key, parse_zed_keys
+
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 DEFAULT_AUTO_INPUT = SCRIPT_DIR / "zed-keymap-auto.json"
@@ -123,13 +125,13 @@ def ordered_contexts(
 
 
 def build_output(
-    grouped: Dict[Optional[str], Dict[str, Any]],
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]],
     preferred_context_order: List[Optional[str]],
 ) -> List[Dict[str, Any]]:
     output: List[Dict[str, Any]] = []
     for context in ordered_contexts(list(grouped.keys()), preferred_context_order):
         bindings = grouped[context]
-        ordered_bindings = {key: bindings[key] for key in sorted(bindings.keys())}
+        ordered_bindings = {format_keys(keys): bindings[keys] for keys in sorted(bindings.keys(), key=keys_sort_key)}
         if context is None:
             output.append({"bindings": ordered_bindings})
         else:
@@ -137,8 +139,8 @@ def build_output(
     return output
 
 
-def keymap_to_grouped(data: List[Dict[str, Any]]) -> Tuple[Dict[Optional[str], Dict[str, Any]], List[Optional[str]]]:
-    grouped: Dict[Optional[str], Dict[str, Any]] = {}
+def keymap_to_grouped(data: List[Dict[str, Any]]) -> Tuple[Dict[Optional[str], Dict[KeySequence, Any]], List[Optional[str]]]:
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]] = {}
     context_order: List[Optional[str]] = []
     for entry in data:
         bindings = entry.get("bindings")
@@ -149,15 +151,16 @@ def keymap_to_grouped(data: List[Dict[str, Any]]) -> Tuple[Dict[Optional[str], D
         if context not in context_order:
             context_order.append(context)
         grouped.setdefault(context, {})
-        grouped[context].update(bindings)
+        for key, value in bindings.items():
+            grouped[context][parse_zed_keys(key)] = value
     return grouped, context_order
 
 
 def merge_grouped(
-    base: Dict[Optional[str], Dict[str, Any]],
-    overlay: Dict[Optional[str], Dict[str, Any]],
-) -> Dict[Optional[str], Dict[str, Any]]:
-    merged: Dict[Optional[str], Dict[str, Any]] = {
+    base: Dict[Optional[str], Dict[KeySequence, Any]],
+    overlay: Dict[Optional[str], Dict[KeySequence, Any]],
+) -> Dict[Optional[str], Dict[KeySequence, Any]]:
+    merged: Dict[Optional[str], Dict[KeySequence, Any]] = {
         context: dict(bindings)
         for context, bindings in base.items()
     }
@@ -168,10 +171,10 @@ def merge_grouped(
 
 
 def compute_manual_overrides(
-    auto_grouped: Dict[Optional[str], Dict[str, Any]],
-    captured_grouped: Dict[Optional[str], Dict[str, Any]],
-) -> Tuple[Dict[Optional[str], Dict[str, Any]], List[Optional[str]]]:
-    overrides: Dict[Optional[str], Dict[str, Any]] = {}
+    auto_grouped: Dict[Optional[str], Dict[KeySequence, Any]],
+    captured_grouped: Dict[Optional[str], Dict[KeySequence, Any]],
+) -> Tuple[Dict[Optional[str], Dict[KeySequence, Any]], List[Optional[str]]]:
+    overrides: Dict[Optional[str], Dict[KeySequence, Any]] = {}
     context_order: List[Optional[str]] = []
     missing = object()
 
@@ -1,12 +1,17 @@
 import argparse
+import hashlib
 import json
+import os
 import platform
 import re
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Union
+
+from keystroke import KeySequence, format_keys, keys_sort_key, parse_vscode_keys, parse_vscode_keystroke, parse_zed_keys
 
 
 SCRIPT_DIR = Path(__file__).resolve().parent
@@ -15,39 +20,13 @@ DEFAULT_AUTO_OUTPUT = SCRIPT_DIR / "zed-keymap-auto.json"
 DEFAULT_REPORT = SCRIPT_DIR / "zed-keymap-report.md"
 DEFAULT_EMACS_BASE = SCRIPT_DIR / "zed-keymap-emacs-base.json"
 DEFAULT_MANUAL_OVERRIDES = SCRIPT_DIR / "zed-keymap-manual.json"
+DEFAULT_RULES = SCRIPT_DIR / "zed-keymap-rules.json"
+DEFAULT_CONTEXT = "Workspace"
+SOURCE_FILES = [Path(__file__).resolve(), SCRIPT_DIR / "keystroke.py"]
+DEFAULT_CACHE = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "zed-keymap" / "conversion-cache.json"
+DEFAULT_BINDING_INDEX = DEFAULT_CACHE.with_name("binding-index.json")
+CACHE_VERSION = 1
 
-MODIFIER_ORDER = ["ctrl", "alt", "shift", "cmd", "super"]
-MODIFIER_ALIASES = {
-    "ctrl": "ctrl",
-    "control": "ctrl",
-    "alt": "alt",
-    "option": "alt",
-    "shift": "shift",
-    "cmd": "cmd",
-    "command": "cmd",
-    "meta": "cmd",
-    "win": "super",
-    "windows": "super",
-    "super": "super",
-}
-KEY_ALIASES = {
-    "esc": "escape",
-    "return": "enter",
-    "del": "delete",
-    "pgup": "pageup",
-    "pgdn": "pagedown",
-    "spacebar": "space",
-    "ins": "insert",
-    "equal": "=",
-    "minus": "-",
-    "semicolon": ";",
-    "quote": "'",
-    "backquote": "`",
-    "slash": "/",
-    "backslash": "\\",
-    "intlbackslash": "\\",
-    "intlyen": "\\",
-}
 EDITOR_WHEN_TOKENS = [
     "editorfocus",
     "editortextfocus",
@@ -273,6 +252,74 @@ KEYED_IGNORE_RULES = {
 }
 
 
+WHEN_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+        (?P<operator>&&|\|\||===|!==|==|!=|=~|<=|>=|<|>|!|\(|\))
+        |(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+        |(?P<word>[^\s!=&|()<>'"~]+)
+    )""",
+    re.VERBOSE,
+)
+WHEN_REGEX_PATTERN = re.compile(r"\s*/((?:[^/\\]|\\.)*)/[a-z]*")
+WHEN_COMPARISON_OPERATORS = {"==", "===", "!=", "!==", "=~", "<", "<=", ">", ">=", "in", "not in"}
+
+
+@dataclass(frozen=True)
+class WhenConstant:
+    value: bool
+
+
+@dataclass(frozen=True)
+class WhenKey:
+    name: str
+
+
+@dataclass(frozen=True)
+class WhenComparison:
+    name: str
+    operator: str
+    value: str
+
+
+@dataclass(frozen=True)
+class WhenNot:
+    operand: "WhenExpression"
+
+
+@dataclass(frozen=True)
+class WhenAnd:
+    operands: Tuple["WhenExpression", ...]
+
+
+@dataclass(frozen=True)
+class WhenOr:
+    operands: Tuple["WhenExpression", ...]
+
+
+WhenExpression = Union[WhenConstant, WhenKey, WhenComparison, WhenNot, WhenAnd, WhenOr]
+
+
+@dataclass(frozen=True)
+class WhenClause:
+    expression: Optional[WhenExpression]
+    identifiers: FrozenSet[str]
+    asserted: FrozenSet[str]
+    equalities: FrozenSet[Tuple[str, str]]
+
+    def implies(self, pattern: "WhenClause") -> bool:
+        return pattern.asserted <= self.asserted and pattern.equalities <= self.equalities
+
+
+@dataclass(frozen=True)
+class ClassificationRule:
+    priority: int
+    when: Tuple[str, ...] = ()
+    command_prefixes: Tuple[str, ...] = ()
+    commands: Tuple[str, ...] = ()
+    context: Optional[str] = None
+    ignore: Optional[str] = None
+
+
 @dataclass
 class SkippedBinding:
     index: int
@@ -290,6 +337,17 @@ class Collision:
     source_index: int
 
 
+@dataclass(frozen=True)
+class BindingOutcome:
+    kind: str
+    key: str
+    command: str
+    reason: Optional[str] = None
+    context: Optional[str] = None
+    normalized_key: Optional[str] = None
+    mapped: Any = None
+
+
 @dataclass
 class IgnoredBinding:
     index: int
@@ -311,136 +369,325 @@ def get_default_vscode_keybindings_path() -> Optional[Path]:
 
 
 def normalize_keystroke(stroke: str) -> Optional[str]:
-    stroke = stroke.strip()
-    if not stroke:
-        return None
-
-    tokens = [token.strip().lower() for token in stroke.split("+")]
-    if not tokens:
-        return None
-
-    key_token = tokens[-1]
-    modifier_tokens = tokens[:-1]
-    if key_token == "":
-        key_token = "+"
-
-    normalized_modifiers: List[str] = []
-    for token in modifier_tokens:
-        if not token:
-            continue
-        mapped = MODIFIER_ALIASES.get(token)
-        if mapped is None:
-            return None
-        normalized_modifiers.append(mapped)
-
-    seen = set()
-    ordered_modifiers: List[str] = []
-    for modifier in MODIFIER_ORDER:
-        if modifier in normalized_modifiers and modifier not in seen:
-            ordered_modifiers.append(modifier)
-            seen.add(modifier)
-
-    normalized_key = KEY_ALIASES.get(key_token, key_token)
-    if normalized_key.startswith("[") and normalized_key.endswith("]") and len(normalized_key) > 2:
-        bracket_token = normalized_key[1:-1].strip().lower()
-        normalized_key = KEY_ALIASES.get(bracket_token, bracket_token)
-    if not normalized_key:
+    keystroke = parse_vscode_keystroke(stroke)
+    if keystroke is None:
         return None
-
-    full = ordered_modifiers + [normalized_key]
-    return "-".join(full)
+    return keystroke.text
 
 
 def normalize_keybinding_key(key: str) -> Optional[str]:
-    strokes = [stroke for stroke in key.strip().split() if stroke]
-    if not strokes:
+    keys = parse_vscode_keys(key)
+    if keys is None:
         return None
+    return format_keys(keys)
+
+
+def tokenize_when(text: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    position = 0
+    while position < len(text):
+        if not text[position:].strip():
+            break
+        match = WHEN_TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ValueError(f"Unexpected character {text[position:].strip()[0]!r} in when clause: {text}")
+        position = match.end()
+        if match.group("operator") is not None:
+            tokens.append(("operator", match.group("operator")))
+            if match.group("operator") == "=~":
+                regex = WHEN_REGEX_PATTERN.match(text, position)
+                if regex is not None:
+                    tokens.append(("value", regex.group(1)))
+                    position = regex.end()
+        elif match.group("string") is not None:
+            tokens.append(("value", match.group("string")[1:-1]))
+        else:
+            tokens.append(("word", match.group("word")))
+    return tokens
 
-    normalized: List[str] = []
-    for stroke in strokes:
-        normalized_stroke = normalize_keystroke(stroke)
-        if normalized_stroke is None:
-            return None
-        normalized.append(normalized_stroke)
-    return " ".join(normalized)
-
-
-def has_when_token(when_text: str, token: str) -> bool:
-    pattern = rf"(?<![A-Za-z0-9_!]){re.escape(token)}(?![A-Za-z0-9_])"
-    return re.search(pattern, when_text) is not None
-
-
-def should_ignore_binding(command: str, when: Optional[str]) -> Optional[str]:
-    when_text = (when or "").lower()
 
-    if command == "":
-        return "empty VSCode command placeholder"
+class WhenParser:
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.tokens = tokenize_when(text)
+        self.position = 0
 
-    if command.startswith("-"):
-        return "VSCode-only unbind entry"
+    def error(self, message: str) -> ValueError:
+        return ValueError(f"{message} in when clause: {self.text}")
 
-    if command in IGNORED_COMMANDS:
-        return "no known Zed equivalent"
+    def peek(self) -> Optional[Tuple[str, str]]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
 
-    if any(command.startswith(prefix) for prefix in IGNORED_COMMAND_PREFIXES):
-        return "VSCode-only keybinding editor command"
+    def accept(self, value: str) -> bool:
+        token = self.peek()
+        if token is not None and token[0] == "operator" and token[1] == value:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self) -> WhenExpression:
+        expression = self.parse_or()
+        if self.peek() is not None:
+            raise self.error(f"Unexpected token {self.peek()[1]!r}")
+        return expression
+
+    def parse_or(self) -> WhenExpression:
+        operands = [self.parse_and()]
+        while self.accept("||"):
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else WhenOr(tuple(operands))
+
+    def parse_and(self) -> WhenExpression:
+        operands = [self.parse_unary()]
+        while self.accept("&&"):
+            operands.append(self.parse_unary())
+        return operands[0] if len(operands) == 1 else WhenAnd(tuple(operands))
+
+    def parse_unary(self) -> WhenExpression:
+        if self.accept("!"):
+            return WhenNot(self.parse_unary())
+        if self.accept("("):
+            expression = self.parse_or()
+            if not self.accept(")"):
+                raise self.error("Missing closing parenthesis")
+            return expression
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> WhenExpression:
+        token = self.peek()
+        if token is None or token[0] == "operator":
+            raise self.error("Expected context key")
+        self.position += 1
+        name = token[1].lower()
+        if token[0] == "word" and name in ("true", "false"):
+            return WhenConstant(name == "true")
+
+        operator = self.comparison_operator()
+        if operator is None:
+            return WhenKey(name)
+        value = self.peek()
+        if value is None or value[0] == "operator":
+            raise self.error(f"Expected value after {operator!r}")
+        self.position += 1
+        return WhenComparison(name, operator, value[1].lower())
+
+    def comparison_operator(self) -> Optional[str]:
+        token = self.peek()
+        if token is None:
+            return None
+        if token[0] == "operator" and token[1] in WHEN_COMPARISON_OPERATORS:
+            self.position += 1
+            return token[1]
+        if token[0] == "word" and token[1] == "in":
+            self.position += 1
+            return "in"
+        following = self.tokens[self.position + 1] if self.position + 1 < len(self.tokens) else None
+        if token[0] == "word" and token[1] == "not" and following == ("word", "in"):
+            self.position += 2
+            return "not in"
+        return None
 
-    if any(has_when_token(when_text, token) for token in IGNORED_WHEN_TOKENS):
-        return "VSCode-only UI context"
 
-    return None
+def collect_when_facts(
+    expression: WhenExpression,
+    positive: bool,
+    identifiers: set,
+    asserted: set,
+    equalities: set,
+) -> None:
+    if isinstance(expression, WhenKey):
+        identifiers.add(expression.name)
+        if positive:
+            asserted.add(expression.name)
+    elif isinstance(expression, WhenComparison):
+        identifiers.add(expression.name)
+        negated = expression.operator in ("!=", "!==", "not in")
+        if expression.value in ("true", "false") and expression.operator in ("==", "===", "!=", "!=="):
+            negated = negated != (expression.value == "false")
+        if positive != negated:
+            asserted.add(expression.name)
+            if expression.operator in ("==", "==="):
+                equalities.add((expression.name, expression.value))
+    elif isinstance(expression, WhenNot):
+        collect_when_facts(expression.operand, not positive, identifiers, asserted, equalities)
+    elif isinstance(expression, (WhenAnd, WhenOr)):
+        for operand in expression.operands:
+            collect_when_facts(operand, positive, identifiers, asserted, equalities)
+
+
+@lru_cache(maxsize=None)
+def parse_when(text: Optional[str]) -> WhenClause:
+    if text is None or not text.strip():
+        return WhenClause(None, frozenset(), frozenset(), frozenset())
+    expression = WhenParser(text).parse()
+    identifiers: set = set()
+    asserted: set = set()
+    equalities: set = set()
+    collect_when_facts(expression, True, identifiers, asserted, equalities)
+    return WhenClause(expression, frozenset(identifiers), frozenset(asserted), frozenset(equalities))
+
+
+DEFAULT_CLASSIFICATION_RULES = [
+    ClassificationRule(10, commands=("",), ignore="empty VSCode command placeholder"),
+    ClassificationRule(20, command_prefixes=("-",), ignore="VSCode-only unbind entry"),
+    ClassificationRule(30, commands=tuple(sorted(IGNORED_COMMANDS)), ignore="no known Zed equivalent"),
+    ClassificationRule(40, command_prefixes=IGNORED_COMMAND_PREFIXES, ignore="VSCode-only keybinding editor command"),
+    ClassificationRule(50, when=tuple(IGNORED_WHEN_TOKENS), ignore="VSCode-only UI context"),
+    ClassificationRule(100, when=("findwidgetvisible",), context="BufferSearchBar > Editor"),
+    ClassificationRule(
+        200,
+        when=("parameterhintsvisible",),
+        context="Editor && showing_signature_help && !showing_completions",
+    ),
+    ClassificationRule(
+        300,
+        when=("suggestwidgetvisible", "codeactionmenuvisible"),
+        context="Editor && (showing_code_actions || showing_completions)",
+    ),
+    ClassificationRule(
+        400,
+        when=("editorhasselection", "selectionanchorset", "emacs-mcx.inmarkmode"),
+        context="Editor && selection_mode",
+    ),
+    ClassificationRule(
+        500,
+        when=("terminalfocus",),
+        command_prefixes=("workbench.action.terminal", "terminal."),
+        context="Terminal",
+    ),
+    ClassificationRule(
+        600,
+        when=tuple(PROJECT_WHEN_TOKENS),
+        command_prefixes=("explorer.", "filesExplorer.", "workbench.files.action"),
+        commands=("renameFile",),
+        context="ProjectPanel && not_editing",
+    ),
+    ClassificationRule(700, when=tuple(MENU_WHEN_TOKENS), command_prefixes=("list.",), context="menu"),
+    ClassificationRule(
+        800,
+        when=tuple(EDITOR_WHEN_TOKENS),
+        command_prefixes=("editor.", "actions.find", "delete", "cursor", "emacs-mcx."),
+        context="Editor && mode == full",
+    ),
+]
 
 
-def infer_context(when: Optional[str], command: str) -> str:
-    when_text = (when or "").lower()
-    base_command = command.lstrip("-")
+class CommandTrieNode:
+    __slots__ = ("children", "prefix_rules", "exact_rules")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "CommandTrieNode"] = {}
+        self.prefix_rules: List[int] = []
+        self.exact_rules: List[int] = []
+
+
+class RuleTable:
+    def __init__(self, rules: List[ClassificationRule]) -> None:
+        self.rules = sorted(rules, key=lambda rule: rule.priority)
+        self.root = CommandTrieNode()
+        self.when_index: Dict[str, List[Tuple[int, WhenClause]]] = defaultdict(list)
+        for index, rule in enumerate(self.rules):
+            for prefix in rule.command_prefixes:
+                self.insert(prefix).prefix_rules.append(index)
+            for command in rule.commands:
+                self.insert(command).exact_rules.append(index)
+            for token in rule.when:
+                pattern = parse_when(token)
+                self.when_index[min(pattern.asserted)].append((index, pattern))
+
+    def insert(self, command: str) -> CommandTrieNode:
+        node = self.root
+        for character in command:
+            node = node.children.setdefault(character, CommandTrieNode())
+        return node
+
+    def command_matches(self, command: str) -> List[int]:
+        node = self.root
+        matches = list(node.prefix_rules)
+        for character in command:
+            child = node.children.get(character)
+            if child is None:
+                return matches
+            node = child
+            matches.extend(node.prefix_rules)
+        matches.extend(node.exact_rules)
+        return matches
+
+    def when_matches(self, clause: WhenClause) -> List[int]:
+        matches: List[int] = []
+        for identifier in clause.asserted:
+            for index, pattern in self.when_index.get(identifier, ()):
+                if clause.implies(pattern):
+                    matches.append(index)
+        return matches
+
+    def matching_rules(self, command: str, clause: WhenClause) -> List[ClassificationRule]:
+        indices = sorted(set(self.command_matches(command) + self.when_matches(clause)))
+        return [self.rules[index] for index in indices]
+
+    def classify(self, command: str, clause: WhenClause) -> Optional[ClassificationRule]:
+        indices = self.command_matches(command) + self.when_matches(clause)
+        if not indices:
+            return None
+        return self.rules[min(indices)]
+
+
+def parse_classification_rule(entry: Any, path: Path) -> ClassificationRule:
+    if not isinstance(entry, dict):
+        raise ValueError(f"Expected rule objects in {path}")
+    priority = entry.get("priority")
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError(f"Rule priority must be an integer in {path}: {entry}")
+
+    lists: Dict[str, Tuple[str, ...]] = {}
+    for field in ("when", "command_prefixes", "commands"):
+        values = entry.get(field, [])
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"Rule {field} must be a list of strings in {path}: {entry}")
+        lists[field] = tuple(values)
+    for token in lists["when"]:
+        if not parse_when(token).asserted:
+            raise ValueError(
+                f"Rule when pattern {token!r} must require at least one context key in {path}: {entry}"
+            )
 
-    if has_when_token(when_text, "findwidgetvisible"):
-        return "BufferSearchBar > Editor"
+    context = entry.get("context")
+    ignore = entry.get("ignore")
+    if (context is None) == (ignore is None):
+        raise ValueError(f"Rule must set exactly one of context or ignore in {path}: {entry}")
+    if not isinstance(context if ignore is None else ignore, str):
+        raise ValueError(f"Rule context or ignore reason must be a string in {path}: {entry}")
+    return ClassificationRule(priority, context=context, ignore=ignore, **lists)
 
-    if has_when_token(when_text, "parameterhintsvisible"):
-        return "Editor && showing_signature_help && !showing_completions"
 
-    if has_when_token(when_text, "suggestwidgetvisible") or has_when_token(when_text, "codeactionmenuvisible"):
-        return "Editor && (showing_code_actions || showing_completions)"
+def load_classification_rules(path: Path) -> List[ClassificationRule]:
+    raw = json.loads(path.read_text(encoding="utf-8"))
+    if not isinstance(raw, list):
+        raise ValueError(f"Expected list JSON in {path}")
+    return [parse_classification_rule(entry, path) for entry in raw]
 
-    if (
-        has_when_token(when_text, "editorhasselection")
-        or has_when_token(when_text, "selectionanchorset")
-        or has_when_token(when_text, "emacs-mcx.inmarkmode")
-    ):
-        return "Editor && selection_mode"
 
-    if (
-        has_when_token(when_text, "terminalfocus")
-        or base_command.startswith("workbench.action.terminal")
-        or base_command.startswith("terminal.")
-    ):
-        return "Terminal"
+DEFAULT_RULE_TABLE = RuleTable(DEFAULT_CLASSIFICATION_RULES)
 
-    if (
-        any(has_when_token(when_text, token) for token in PROJECT_WHEN_TOKENS)
-        or base_command.startswith("explorer.")
-        or base_command.startswith("filesExplorer.")
-        or base_command.startswith("workbench.files.action")
-        or base_command == "renameFile"
-    ):
-        return "ProjectPanel && not_editing"
 
-    if any(has_when_token(when_text, token) for token in MENU_WHEN_TOKENS) or base_command.startswith("list."):
-        return "menu"
+def should_ignore_binding(
+    command: str,
+    when: Optional[str],
+    table: Optional[RuleTable] = None,
+) -> Optional[str]:
+    rule = (table or DEFAULT_RULE_TABLE).classify(command, parse_when(when))
+    if rule is None:
+        return None
+    return rule.ignore
 
-    if (
-        any(has_when_token(when_text, token) for token in EDITOR_WHEN_TOKENS)
-        or base_command.startswith("editor.")
-        or base_command.startswith("actions.find")
-        or base_command.startswith("delete")
-        or base_command.startswith("cursor")
-        or base_command.startswith("emacs-mcx.")
-    ):
-        return "Editor && mode == full"
 
-    return "Workspace"
+def infer_context(when: Optional[str], command: str, table: Optional[RuleTable] = None) -> str:
+    for rule in (table or DEFAULT_RULE_TABLE).matching_rules(command.lstrip("-"), parse_when(when)):
+        if rule.context is not None:
+            return rule.context
+    return DEFAULT_CONTEXT
 
 
 def map_run_commands(args: Any) -> Optional[Any]:
@@ -501,13 +748,13 @@ def ordered_contexts(
 
 
 def build_output(
-    grouped: Dict[Optional[str], Dict[str, Any]],
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]],
     preferred_context_order: List[Optional[str]],
 ) -> List[Dict[str, Any]]:
     output: List[Dict[str, Any]] = []
     for context in ordered_contexts(list(grouped.keys()), preferred_context_order):
         bindings = grouped[context]
-        ordered_bindings = {key: bindings[key] for key in sorted(bindings.keys())}
+        ordered_bindings = {format_keys(keys): bindings[keys] for keys in sorted(bindings.keys(), key=keys_sort_key)}
         if context is None:
             output.append({"bindings": ordered_bindings})
         else:
@@ -520,12 +767,12 @@ def write_json(path: Path, data: Any) -> None:
     path.write_text(json.dumps(data, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
 
 
-def load_grouped_keymap(path: Path) -> Tuple[Dict[Optional[str], Dict[str, Any]], List[Optional[str]]]:
+def load_grouped_keymap(path: Path) -> Tuple[Dict[Optional[str], Dict[KeySequence, Any]], List[Optional[str]]]:
     raw = json.loads(path.read_text(encoding="utf-8"))
     if not isinstance(raw, list):
         raise ValueError(f"Expected list JSON in {path}")
 
-    grouped: Dict[Optional[str], Dict[str, Any]] = defaultdict(dict)
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]] = defaultdict(dict)
     context_order: List[Optional[str]] = []
     for entry in raw:
         if not isinstance(entry, dict):
@@ -538,16 +785,16 @@ def load_grouped_keymap(path: Path) -> Tuple[Dict[Optional[str], Dict[str, Any]]
         if context not in context_order:
             context_order.append(context)
         for key, value in bindings.items():
-            if isinstance(key, str) and key:
-                grouped[context][key] = value
+            if isinstance(key, str) and key.strip():
+                grouped[context][parse_zed_keys(key)] = value
     return grouped, context_order
 
 
 def merge_grouped(
-    base: Dict[Optional[str], Dict[str, Any]],
-    overlay: Dict[Optional[str], Dict[str, Any]],
-) -> Dict[Optional[str], Dict[str, Any]]:
-    merged: Dict[Optional[str], Dict[str, Any]] = {
+    base: Dict[Optional[str], Dict[KeySequence, Any]],
+    overlay: Dict[Optional[str], Dict[KeySequence, Any]],
+) -> Dict[Optional[str], Dict[KeySequence, Any]]:
+    merged: Dict[Optional[str], Dict[KeySequence, Any]] = {
         context: dict(bindings)
         for context, bindings in base.items()
     }
@@ -558,27 +805,27 @@ def merge_grouped(
 
 
 def apply_project_panel_fallback_bindings(
-    grouped: Dict[Optional[str], Dict[str, Any]],
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]],
 ) -> None:
     bindings = grouped.setdefault("ProjectPanel && not_editing", {})
     for key, value in PROJECT_PANEL_FALLBACK_BINDINGS.items():
-        bindings[key] = value
+        bindings[parse_zed_keys(key)] = value
 
 
 def apply_editor_fallback_bindings(
-    grouped: Dict[Optional[str], Dict[str, Any]],
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]],
 ) -> None:
     bindings = grouped.setdefault("Editor", {})
     for key, value in EDITOR_FALLBACK_BINDINGS.items():
-        bindings[key] = value
+        bindings[parse_zed_keys(key)] = value
 
 
 def apply_workspace_fallback_bindings(
-    grouped: Dict[Optional[str], Dict[str, Any]],
+    grouped: Dict[Optional[str], Dict[KeySequence, Any]],
 ) -> None:
     bindings = grouped.setdefault("Workspace", {})
     for key, value in WORKSPACE_FALLBACK_BINDINGS.items():
-        bindings[key] = value
+        bindings[parse_zed_keys(key)] = value
 
 
 def build_report(
@@ -587,6 +834,8 @@ def build_report(
     auto_output: Path,
     manual_overrides: Optional[Path],
     manual_loaded: bool,
+    rules: Optional[Path],
+    rules_loaded: bool,
     emacs_base: Optional[Path],
     total: int,
     mapped: int,
@@ -605,6 +854,8 @@ def build_report(
         f"- Emacs base: `{emacs_base}`",
         f"- Manual overrides: `{manual_overrides}`",
         f"- Manual overrides loaded: `{manual_loaded}`",
+        f"- Classification rules: `{rules}`",
+        f"- Classification rules loaded: `{rules_loaded}`",
         f"- Total bindings: `{total}`",
         f"- Converted bindings: `{mapped}`",
         f"- Unbound bindings: `{unbound}`",
@@ -651,6 +902,151 @@ def build_report(
     return "\n".join(lines)
 
 
+def file_digest(path: Optional[Path]) -> Optional[str]:
+    if path is None or not path.exists():
+        return None
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def source_digest() -> str:
+    return hashlib.sha256("".join(file_digest(path) or "" for path in SOURCE_FILES).encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def mapping_tables_digest() -> str:
+    tables = [
+        sorted(COMMAND_MAP.items()),
+        sorted(SPECIAL_RUN_COMMANDS_MAP.items()),
+        sorted(EDITOR_FALLBACK_BINDINGS.items()),
+        sorted(PROJECT_PANEL_FALLBACK_BINDINGS.items()),
+        sorted(WORKSPACE_FALLBACK_BINDINGS.items()),
+        sorted(EMACS_BASE_PRESERVE_RULES.items()),
+        sorted(KEYED_IGNORE_RULES.items()),
+        DEFAULT_CLASSIFICATION_RULES,
+    ]
+    return hashlib.sha256(repr(tables).encode("utf-8")).hexdigest()
+
+
+def conversion_cache_key(
+    source: Path,
+    final_output: Path,
+    auto_output: Path,
+    report: Path,
+    emacs_base: Optional[Path],
+    manual_overrides: Optional[Path],
+    rules: Optional[Path],
+) -> str:
+    material = {
+        "version": CACHE_VERSION,
+        "script": source_digest(),
+        "tables": mapping_tables_digest(),
+        "source": file_digest(source),
+        "emacs_base": file_digest(emacs_base),
+        "manual_overrides": file_digest(manual_overrides),
+        "rules": file_digest(rules),
+        "paths": [str(path) for path in (final_output, auto_output, report, emacs_base, manual_overrides, rules)],
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_conversion_cache(path: Path) -> Dict[str, Any]:
+    try:
+        raw = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return raw if isinstance(raw, dict) else {}
+
+
+def is_cache_hit(cache: Dict[str, Any], key: str, outputs: List[Path]) -> bool:
+    recorded = cache.get("outputs")
+    if cache.get("key") != key or not isinstance(recorded, dict):
+        return False
+    return all(
+        recorded.get(str(path)) is not None and recorded.get(str(path)) == file_digest(path)
+        for path in outputs
+    )
+
+
+def write_conversion_cache(path: Path, key: str, outputs: List[Path]) -> None:
+    write_json(path, {"key": key, "outputs": {str(output): file_digest(output) for output in outputs}})
+
+
+def binding_fingerprint(binding: Any) -> str:
+    if isinstance(binding, dict):
+        return repr((binding.get("key"), binding.get("command"), binding.get("when"), binding.get("args")))
+    return repr(("entry", binding))
+
+
+def classify_binding(binding: Any, table: RuleTable) -> BindingOutcome:
+    if not isinstance(binding, dict):
+        return BindingOutcome("skipped", "", "", "binding entry is not object")
+
+    raw_key = binding.get("key", "")
+    raw_command = binding.get("command", "")
+    when = binding.get("when")
+    args = binding.get("args")
+
+    if not isinstance(raw_command, str):
+        return BindingOutcome("skipped", str(raw_key), str(raw_command), "command is not string")
+
+    if not isinstance(when, str):
+        when = None
+    try:
+        clause = parse_when(when)
+    except ValueError as error:
+        return BindingOutcome("skipped", str(raw_key), raw_command, str(error))
+
+    rule = table.classify(raw_command, clause)
+    if rule is not None and rule.ignore is not None:
+        return BindingOutcome("ignored", str(raw_key), raw_command, rule.ignore)
+
+    if not isinstance(raw_key, str) or not raw_key.strip():
+        return BindingOutcome("skipped", str(raw_key), raw_command, "missing key")
+
+    normalized_key = normalize_keybinding_key(raw_key)
+    if normalized_key is None:
+        return BindingOutcome("skipped", raw_key, raw_command, "unsupported key expression")
+
+    context: Optional[str] = rule.context if rule is not None and rule.context is not None else DEFAULT_CONTEXT
+    keyed_ignore_reason = KEYED_IGNORE_RULES.get((context, normalized_key, raw_command))
+    if keyed_ignore_reason is not None:
+        return BindingOutcome("ignored", raw_key, raw_command, keyed_ignore_reason)
+
+    ok, mapped, reason = map_command(raw_command, args)
+    if not ok:
+        return BindingOutcome("skipped", raw_key, raw_command, reason or "unknown conversion error")
+
+    if raw_command == "runCommands" and mapped == "project_panel::ToggleFocus" and normalized_key == "ctrl-q":
+        context = None
+
+    return BindingOutcome("mapped", raw_key, raw_command, None, context, normalized_key, mapped)
+
+
+def binding_index_digest(rules: Optional[Path]) -> str:
+    material = [CACHE_VERSION, source_digest(), mapping_tables_digest(), file_digest(rules)]
+    return hashlib.sha256(json.dumps(material).encode("utf-8")).hexdigest()
+
+
+def load_binding_index(path: Path, digest: str) -> Dict[str, BindingOutcome]:
+    raw = load_conversion_cache(path)
+    entries = raw.get("bindings")
+    if raw.get("digest") != digest or not isinstance(entries, dict):
+        return {}
+    if not all(isinstance(entry, list) for entry in entries.values()):
+        return {}
+    try:
+        return {fingerprint: BindingOutcome(*entry) for fingerprint, entry in entries.items()}
+    except TypeError:
+        return {}
+
+
+def write_binding_index(path: Path, digest: str, outcomes: Dict[str, BindingOutcome]) -> None:
+    bindings = {fingerprint: astuple(outcome) for fingerprint, outcome in sorted(outcomes.items())}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"digest": digest, "bindings": bindings}, ensure_ascii=False), encoding="utf-8")
+
+
 def convert(
     source: Path,
     final_output: Path,
@@ -658,12 +1054,32 @@ def convert(
     report: Path,
     emacs_base: Optional[Path],
     manual_overrides: Optional[Path],
+    rules: Optional[Path] = None,
+    cache: Optional[Path] = None,
+    index_path: Optional[Path] = None,
 ) -> None:
+    outputs = [auto_output, final_output, report]
+    cache_key = ""
+    if cache is not None:
+        cache_key = conversion_cache_key(
+            source, final_output, auto_output, report, emacs_base, manual_overrides, rules
+        )
+        if is_cache_hit(load_conversion_cache(cache), cache_key, outputs):
+            print(f"Zed keymap is up to date (cache hit): {final_output}")
+            return
+
     raw_bindings = json.loads(source.read_text(encoding="utf-8"))
     if not isinstance(raw_bindings, list):
         raise ValueError(f"Expected list JSON in {source}")
 
-    auto_grouped: Dict[Optional[str], Dict[str, Any]] = defaultdict(dict)
+    table = DEFAULT_RULE_TABLE
+    rules_loaded = False
+    if rules is not None and rules.exists():
+        table = RuleTable(DEFAULT_CLASSIFICATION_RULES + load_classification_rules(rules))
+        rules_loaded = True
+    rules_digest = binding_index_digest(rules if rules_loaded else None)
+
+    auto_grouped: Dict[Optional[str], Dict[KeySequence, Any]] = defaultdict(dict)
     preferred_context_order: List[Optional[str]] = []
     if emacs_base is not None:
         base_grouped, preferred_context_order = load_grouped_keymap(emacs_base)
@@ -676,111 +1092,63 @@ def convert(
     mapped_count = 0
     unbound_count = 0
 
+    binding_index: Dict[str, BindingOutcome] = {}
+    if index_path is not None:
+        binding_index = load_binding_index(index_path, rules_digest)
+    outcomes: Dict[str, BindingOutcome] = {}
+    reused = 0
+
     missing = object()
     for index, binding in enumerate(raw_bindings, start=1):
-        if not isinstance(binding, dict):
-            skipped.append(
-                SkippedBinding(
-                    index=index,
-                    key="",
-                    command="",
-                    reason="binding entry is not object",
-                )
-            )
-            continue
-
-        raw_key = binding.get("key", "")
-        raw_command = binding.get("command", "")
-        when = binding.get("when")
-        args = binding.get("args")
-
-        if not isinstance(raw_command, str):
-            skipped.append(
-                SkippedBinding(
-                    index=index,
-                    key=str(raw_key),
-                    command=str(raw_command),
-                    reason="command is not string",
-                )
-            )
-            continue
-
-        ignore_reason = should_ignore_binding(raw_command, when if isinstance(when, str) else None)
-        if ignore_reason is not None:
+        fingerprint = binding_fingerprint(binding)
+        outcome = outcomes.get(fingerprint)
+        if outcome is None:
+            outcome = binding_index.get(fingerprint)
+            if outcome is None:
+                outcome = classify_binding(binding, table)
+            else:
+                reused += 1
+            outcomes[fingerprint] = outcome
+
+        if outcome.kind == "ignored":
             ignored.append(
                 IgnoredBinding(
                     index=index,
-                    key=str(raw_key),
-                    command=raw_command,
-                    reason=ignore_reason,
-                )
-            )
-            continue
-
-        if not isinstance(raw_key, str) or not raw_key.strip():
-            skipped.append(
-                SkippedBinding(
-                    index=index,
-                    key=str(raw_key),
-                    command=str(raw_command),
-                    reason="missing key",
+                    key=outcome.key,
+                    command=outcome.command,
+                    reason=outcome.reason or "",
                 )
             )
             continue
 
-        normalized_key = normalize_keybinding_key(raw_key)
-        if normalized_key is None:
+        if outcome.kind == "skipped":
             skipped.append(
                 SkippedBinding(
                     index=index,
-                    key=raw_key,
-                    command=str(raw_command),
-                    reason="unsupported key expression",
+                    key=outcome.key,
+                    command=outcome.command,
+                    reason=outcome.reason or "unknown conversion error",
                 )
             )
             continue
 
-        context = infer_context(when if isinstance(when, str) else None, raw_command)
-        keyed_ignore_reason = KEYED_IGNORE_RULES.get((context, normalized_key, raw_command))
-        if keyed_ignore_reason is not None:
+        context = outcome.context
+        normalized_key = outcome.normalized_key or ""
+        keys = parse_zed_keys(normalized_key)
+        mapped = outcome.mapped
+        preserve_reason = EMACS_BASE_PRESERVE_RULES.get((context, normalized_key, outcome.command))
+        if preserve_reason is not None and keys in auto_grouped[context]:
             ignored.append(
                 IgnoredBinding(
                     index=index,
-                    key=raw_key,
-                    command=raw_command,
-                    reason=keyed_ignore_reason,
-                )
-            )
-            continue
-
-        ok, mapped, reason = map_command(raw_command, args)
-        if not ok:
-            skipped.append(
-                SkippedBinding(
-                    index=index,
-                    key=raw_key,
-                    command=raw_command,
-                    reason=reason or "unknown conversion error",
-                )
-            )
-            continue
-
-        if raw_command == "runCommands" and mapped == "project_panel::ToggleFocus" and normalized_key == "ctrl-q":
-            context = None
-
-        preserve_reason = EMACS_BASE_PRESERVE_RULES.get((context, normalized_key, raw_command))
-        if preserve_reason is not None and normalized_key in auto_grouped[context]:
-            ignored.append(
-                IgnoredBinding(
-                    index=index,
-                    key=raw_key,
-                    command=raw_command,
+                    key=outcome.key,
+                    command=outcome.command,
                     reason=preserve_reason,
                 )
             )
             continue
 
-        existing = auto_grouped[context].get(normalized_key, missing)
+        existing = auto_grouped[context].get(keys, missing)
         if existing is not missing and existing != mapped:
             collisions.append(
                 Collision(
@@ -792,12 +1160,15 @@ def convert(
                 )
             )
 
-        auto_grouped[context][normalized_key] = mapped
+        auto_grouped[context][keys] = mapped
         if mapped is None:
             unbound_count += 1
         else:
             mapped_count += 1
 
+    if index_path is not None and outcomes.keys() != binding_index.keys():
+        write_binding_index(index_path, rules_digest, outcomes)
+
     auto_data = build_output(auto_grouped, preferred_context_order)
     apply_editor_fallback_bindings(auto_grouped)
     apply_project_panel_fallback_bindings(auto_grouped)
@@ -805,7 +1176,7 @@ def convert(
     auto_data = build_output(auto_grouped, preferred_context_order)
     write_json(auto_output, auto_data)
 
-    manual_grouped: Dict[Optional[str], Dict[str, Any]] = {}
+    manual_grouped: Dict[Optional[str], Dict[KeySequence, Any]] = {}
     manual_context_order: List[Optional[str]] = []
     manual_loaded = False
     if manual_overrides is not None and manual_overrides.exists():
@@ -830,6 +1201,8 @@ def convert(
         auto_output=auto_output,
         manual_overrides=manual_overrides,
         manual_loaded=manual_loaded,
+        rules=rules,
+        rules_loaded=rules_loaded,
         emacs_base=emacs_base,
         total=len(raw_bindings),
         mapped=mapped_count,
@@ -840,8 +1213,12 @@ def convert(
     )
     report.parent.mkdir(parents=True, exist_ok=True)
     report.write_text(report_text, encoding="utf-8")
+    if cache is not None:
+        write_conversion_cache(cache, cache_key, outputs)
 
     print(f"Converted {mapped_count} bindings, unbound {unbound_count}, ignored {len(ignored)}, skipped {len(skipped)}")
+    if index_path is not None:
+        print(f"Reused {reused} indexed binding outcomes, classified {len(outcomes) - reused}")
     print(f"Wrote auto keymap: {auto_output}")
     print(f"Wrote final keymap: {final_output}")
     print(f"Wrote report: {report}")
@@ -867,6 +1244,11 @@ def main() -> None:
         default=str(DEFAULT_MANUAL_OVERRIDES),
         help=f"Path to manual override keymap JSON (default: {DEFAULT_MANUAL_OVERRIDES})",
     )
+    parser.add_argument(
+        "--rules",
+        default=str(DEFAULT_RULES),
+        help=f"Path to extra context/ignore classification rules JSON (default: {DEFAULT_RULES})",
+    )
     parser.add_argument(
         "--report",
         default=str(DEFAULT_REPORT),
@@ -887,6 +1269,26 @@ def main() -> None:
         action="store_true",
         help="Do not merge manual override keymap",
     )
+    parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Do not load extra classification rules",
+    )
+    parser.add_argument(
+        "--cache",
+        default=str(DEFAULT_CACHE),
+        help=f"Path to conversion cache; unchanged inputs skip conversion (default: {DEFAULT_CACHE})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always convert, ignoring and not updating the conversion cache and binding index",
+    )
+    parser.add_argument(
+        "--binding-index",
+        default=str(DEFAULT_BINDING_INDEX),
+        help=f"Path to per-binding conversion index (default: {DEFAULT_BINDING_INDEX})",
+    )
     args = parser.parse_args()
 
     if args.input:
@@ -914,6 +1316,16 @@ def main() -> None:
     if not args.no_manual_overrides:
         manual_overrides = Path(args.manual_overrides).expanduser().resolve()
 
+    rules: Optional[Path] = None
+    if not args.no_rules:
+        rules = Path(args.rules).expanduser().resolve()
+
+    cache: Optional[Path] = None
+    index_path: Optional[Path] = None
+    if not args.no_cache:
+        cache = Path(args.cache).expanduser().resolve()
+        index_path = Path(args.binding_index).expanduser().resolve()
+
     convert(
         source=source,
         final_output=final_output,
@@ -921,6 +1333,9 @@ def main() -> None:
         report=report,
         emacs_base=emacs_base,
         manual_overrides=manual_overrides,
+        rules=rules,
+        cache=cache,
+        index_path=index_path,
     )
 
 
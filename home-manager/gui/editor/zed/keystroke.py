@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from typing import Dict, List, Optional, Tuple
+
+
+MODIFIER_ORDER = ["ctrl", "alt", "shift", "cmd", "super"]
+MODIFIER_BITS = {modifier: 1 << index for index, modifier in enumerate(MODIFIER_ORDER)}
+MODIFIER_ALIASES = {
+    "ctrl": "ctrl",
+    "control": "ctrl",
+    "alt": "alt",
+    "option": "alt",
+    "shift": "shift",
+    "cmd": "cmd",
+    "command": "cmd",
+    "meta": "cmd",
+    "win": "super",
+    "windows": "super",
+    "super": "super",
+}
+KEY_ALIASES = {
+    "esc": "escape",
+    "return": "enter",
+    "del": "delete",
+    "pgup": "pageup",
+    "pgdn": "pagedown",
+    "spacebar": "space",
+    "ins": "insert",
+    "equal": "=",
+    "minus": "-",
+    "semicolon": ";",
+    "quote": "'",
+    "backquote": "`",
+    "slash": "/",
+    "backslash": "\\",
+    "intlbackslash": "\\",
+    "intlyen": "\\",
+}
+
+KEY_NAMES: List[str] = []
+KEY_IDS: Dict[str, int] = {}
+
+
+def intern_key(name: str) -> int:
+    key_id = KEY_IDS.get(name)
+    if key_id is None:
+        key_id = len(KEY_NAMES)
+        KEY_IDS[name] = key_id
+        KEY_NAMES.append(name)
+    return key_id
+
+
+@dataclass(frozen=True)
+class Keystroke:
+    modifiers: int
+    key: int
+
+    @property
+    def key_name(self) -> str:
+        return KEY_NAMES[self.key]
+
+    @cached_property
+    def text(self) -> str:
+        names = [modifier for modifier in MODIFIER_ORDER if self.modifiers & MODIFIER_BITS[modifier]]
+        return "-".join(names + [self.key_name])
+
+    def __str__(self) -> str:
+        return self.text
+
+
+KeySequence = Tuple[Keystroke, ...]
+
+
+@lru_cache(maxsize=None)
+def make_keystroke(modifiers: int, key_name: str) -> Keystroke:
+    return Keystroke(modifiers, intern_key(key_name))
+
+
+@lru_cache(maxsize=None)
+def parse_vscode_keystroke(stroke: str) -> Optional[Keystroke]:
+    stroke = stroke.strip()
+    if not stroke:
+        return None
+
+    tokens = [token.strip().lower() for token in stroke.split("+")]
+    key_token = tokens[-1]
+    if key_token == "":
+        key_token = "+"
+
+    modifiers = 0
+    for token in tokens[:-1]:
+        if not token:
+            continue
+        mapped = MODIFIER_ALIASES.get(token)
+        if mapped is None:
+            return None
+        modifiers |= MODIFIER_BITS[mapped]
+
+    key_name = KEY_ALIASES.get(key_token, key_token)
+    if key_name.startswith("[") and key_name.endswith("]") and len(key_name) > 2:
+        bracket_token = key_name[1:-1].strip().lower()
+        key_name = KEY_ALIASES.get(bracket_token, bracket_token)
+    if not key_name:
+        return None
+    return make_keystroke(modifiers, key_name)
+
+
+@lru_cache(maxsize=None)
+def parse_vscode_keys(key: str) -> Optional[KeySequence]:
+    strokes = key.strip().split()
+    if not strokes:
+        return None
+
+    parsed: List[Keystroke] = []
+    for stroke in strokes:
+        keystroke = parse_vscode_keystroke(stroke)
+        if keystroke is None:
+            return None
+        parsed.append(keystroke)
+    return tuple(parsed)
+
+
+@lru_cache(maxsize=None)
+def parse_zed_keystroke(stroke: str) -> Keystroke:
+    if stroke == "-" or stroke.endswith("--"):
+        modifier_names = stroke[:-2].split("-") if len(stroke) > 1 else []
+        key_name = "-"
+    else:
+        *modifier_names, key_name = stroke.split("-")
+
+    modifiers = 0
+    for name in modifier_names:
+        bit = MODIFIER_BITS.get(name)
+        if bit is None or modifiers & bit or not key_name:
+            return make_keystroke(0, stroke)
+        modifiers |= bit
+    return make_keystroke(modifiers, key_name)
+
+
+@lru_cache(maxsize=None)
+def parse_zed_keys(key: str) -> KeySequence:
+    return tuple(parse_zed_keystroke(stroke) for stroke in key.split())
+
+
+@lru_cache(maxsize=None)
+def format_keys(keys: KeySequence) -> str:
+    return " ".join(keystroke.text for keystroke in keys)
+
+
+def keys_sort_key(keys: KeySequence) -> Tuple[str, ...]:
+    return tuple(keystroke.text for keystroke in keys)
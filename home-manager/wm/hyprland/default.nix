@@ -1015,7 +1015,11 @@ in
       ExecStart = "${pipWindowState}/bin/pip-window-state daemon";
       Restart = "on-failure";
       RestartSec = 2;
-      Environment = [ "PIP_WINDOW_STATE_HYPRCTL=/run/current-system/sw/bin/hyprctl" ];
+      Environment = [
+        "PIP_WINDOW_STATE_HYPRCTL=/run/current-system/sw/bin/hyprctl"
+        # Append placements to a journal instead of fsyncing a rewrite per save. / 保存ごとの fsync 付き書き換えではなくジャーナルへ追記。
+        "PIP_WINDOW_STATE_STORE=journal"
+      ];
     };
     Install = { WantedBy = [ "graphical-session.target" ]; };
   };
@@ -3,27 +3,40 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import bisect
+import cProfile
+import functools
 import json
 import math
 import os
+import re
 import signal
 import socket
 import subprocess
 import sys
 import tempfile
 import time
-from dataclasses import asdict, dataclass
+from collections import deque
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterable, TypeVar
 
 
-STATE_VERSION = 3
-SUPPORTED_STATE_VERSIONS = {1, 2, STATE_VERSION}
+STATE_VERSION = 5
+REQUEST_TIMEOUT = 5.0
+RECONNECT_INITIAL_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5.0
+SUPPORTED_STATE_VERSIONS = {1, 2, 3, 4, STATE_VERSION}
+# Placements migrated from a layout-less state file. / レイアウト情報のない状態ファイルから移行した配置。
+LEGACY_LAYOUT = ""
 PIP_TITLES = {"Picture in picture", "ピクチャー イン ピクチャー"}
-RELEVANT_WINDOW_EVENTS = {
+REGEX_METACHARACTERS = set("\\.^$*+?()[]{}|")
+WINDOW_TABLE_EVENTS = {
+    "changefloatingmode",
     "closewindow",
+    "movewindowv2",
     "openwindow",
-    "windowtitle",
     "windowtitlev2",
 }
 RELEVANT_MONITOR_EVENTS = {
@@ -31,24 +44,160 @@ RELEVANT_MONITOR_EVENTS = {
     "monitoradded",
     "monitoraddedv2",
     "monitorremoved",
+    "monitorremovedv2",
 }
+PIP_GEOMETRY_EVENT = "pipwindowmoved"
+TRACKED_WINDOW_EVENTS = {"activewindowv2"}
+TITLE_EVENTS = {"windowtitle", "windowtitlev2"}
+TRACKING_MODES = ("events", "poll")
+CONTROL_COMMANDS = ("status", "reset", "stats")
+INSTANCE_MODES = ("current", "all")
+DAEMON_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2)
+SLOWEST_CALLS = 10
+STALE_INSTANCE_SCANS = 3
+LATE_EVENT_TOLERANCE = 0.05
+LATENCY_BUCKETS_MS = (
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    25.0,
+    50.0,
+    100.0,
+    250.0,
+    1000.0,
+)
 
 
 class PipStateError(RuntimeError):
     pass
 
 
+class HyprlandUnavailable(PipStateError):
+    pass
+
+
+@dataclass
+class LatencyHistogram:
+    counts: list[int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    )
+    total: float = 0.0
+    maximum: float = 0.0
+
+    def record(self, seconds: float) -> None:
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)] += 1
+        self.total += milliseconds
+        self.maximum = max(self.maximum, milliseconds)
+
+    def to_json(self) -> dict[str, Any]:
+        labels = [f"<={bound:g}ms" for bound in LATENCY_BUCKETS_MS]
+        labels.append(f">{LATENCY_BUCKETS_MS[-1]:g}ms")
+        return {
+            "count": sum(self.counts),
+            "total_ms": round(self.total, 3),
+            "max_ms": round(self.maximum, 3),
+            "buckets": {
+                label: count for label, count in zip(labels, self.counts) if count
+            },
+        }
+
+
+PHASE_TIMINGS: dict[str, LatencyHistogram] = {}
+Timed = TypeVar("Timed", bound=Callable[..., Any])
+
+
+def timed_phase(phase: str) -> Callable[[Timed], Timed]:
+    histogram = PHASE_TIMINGS.setdefault(phase, LatencyHistogram())
+
+    def decorate(function: Timed) -> Timed:
+        @functools.wraps(function)
+        def timed(*arguments: Any, **keywords: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                histogram.record(time.perf_counter() - started)
+
+        return timed
+
+    return decorate
+
+
+@dataclass
+class EventStats:
+    processed: int = 0
+    dropped: int = 0
+    batches: int = 0
+    refresh_requests: int = 0
+    refreshes: int = 0
+    reconnects: int = 0
+    received: dict[str, int] = field(default_factory=dict)
+    blocked: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    def coalescing_ratio(self) -> float:
+        return self.refresh_requests / self.refreshes if self.refreshes else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"processed {self.processed} events, dropped {self.dropped}, "
+            f"coalesced {self.refresh_requests} refresh requests into "
+            f"{self.refreshes} refreshes over {self.batches} batches "
+            f"(ratio {self.coalescing_ratio():.2f})"
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "received": dict(sorted(self.received.items())),
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "refresh_requests": self.refresh_requests,
+            "refreshes": self.refreshes,
+            "reconnects": self.reconnects,
+            "blocked": self.blocked.to_json(),
+        }
+
+
+@dataclass
+class EventBatch:
+    windows: bool = False
+    resync: bool = False
+
+    @property
+    def dirty(self) -> bool:
+        return self.windows
+
+
 def log(message: str) -> None:
     print(f"pip-window-state: {message}", file=sys.stderr, flush=True)
 
 
-def env_float(name: str, default: float) -> float:
+def env_float(name: str, default: float, allow_zero: bool = False) -> float:
     raw = os.environ.get(name, str(default))
     try:
         value = float(raw)
     except ValueError as error:
         raise PipStateError(f"{name} must be a number, got {raw!r}") from error
+    if allow_zero and value == 0:
+        return value
     if not math.isfinite(value) or value <= 0:
+        qualifier = "zero or greater" if allow_zero else "greater than zero"
+        raise PipStateError(f"{name} must be {qualifier}, got {raw!r}")
+    return value
+
+
+def env_int(name: str, default: int) -> int:
+    raw = os.environ.get(name, str(default))
+    try:
+        value = int(raw)
+    except ValueError as error:
+        raise PipStateError(f"{name} must be an integer, got {raw!r}") from error
+    if value <= 0:
         raise PipStateError(f"{name} must be greater than zero, got {raw!r}")
     return value
 
@@ -60,7 +209,7 @@ class LegacyPosition:
     y: int
 
     def to_json(self) -> dict[str, int | str]:
-        return {"version": 2, **asdict(self)}
+        return asdict(self)
 
 
 @dataclass(frozen=True)
@@ -71,7 +220,96 @@ class Placement:
     width: int
 
     def to_json(self) -> dict[str, int | str]:
-        return {"version": STATE_VERSION, **asdict(self)}
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class WindowIdentity:
+    window_class: str
+    title: str
+    order: int
+
+    def to_json(self) -> dict[str, int | str]:
+        return {"class": self.window_class, "title": self.title, "order": self.order}
+
+
+DEFAULT_IDENTITY = WindowIdentity("", "Picture in picture", 0)
+
+
+PlacementEntries = dict[WindowIdentity, LegacyPosition | Placement]
+
+
+class PlacementState:
+    def __init__(self, limit: int, layout_limit: int) -> None:
+        self.limit = limit
+        self.layout_limit = layout_limit
+        self.layouts: dict[str, PlacementEntries] = {}
+
+    @staticmethod
+    def _find(
+        entries: PlacementEntries, identity: WindowIdentity
+    ) -> LegacyPosition | Placement | None:
+        placement = entries.get(identity)
+        if placement is not None:
+            return placement
+        for candidate, placement in reversed(entries.items()):
+            if (
+                candidate.window_class == identity.window_class
+                and candidate.order == identity.order
+            ):
+                return placement
+        return None
+
+    def get(
+        self,
+        layout: str,
+        identity: WindowIdentity,
+        connected: set[str] | None = None,
+    ) -> LegacyPosition | Placement | None:
+        entries = self.layouts.get(layout)
+        if entries is not None:
+            placement = self._find(entries, identity)
+            if placement is not None:
+                return placement
+        if connected is None:
+            return None
+        for other, entries in reversed(self.layouts.items()):
+            if other == layout:
+                continue
+            placement = self._find(entries, identity)
+            if placement is not None and placement.monitor in connected:
+                return placement
+        return None
+
+    def put(
+        self,
+        layout: str,
+        identity: WindowIdentity,
+        placement: LegacyPosition | Placement,
+    ) -> None:
+        entries = self.layouts.pop(layout, {})
+        self.layouts[layout] = entries
+        entries.pop(identity, None)
+        entries[identity] = placement
+        while len(entries) > self.limit:
+            del entries[next(iter(entries))]
+        while len(self.layouts) > self.layout_limit:
+            del self.layouts[next(iter(self.layouts))]
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "version": STATE_VERSION,
+            "layouts": [
+                {
+                    "layout": layout,
+                    "placements": [
+                        {**identity.to_json(), **placement.to_json()}
+                        for identity, placement in reversed(entries.items())
+                    ],
+                }
+                for layout, entries in reversed(self.layouts.items())
+            ],
+        }
 
 
 @dataclass(frozen=True)
@@ -82,6 +320,7 @@ class Monitor:
     y: int
     width: int
     height: int
+    scale: float
 
     @classmethod
     def from_hyprland(cls, raw: dict[str, Any]) -> Monitor:
@@ -103,89 +342,363 @@ class Monitor:
             y=int(raw["y"]),
             width=math.floor(physical_width / scale),
             height=math.floor(physical_height / scale),
+            scale=scale,
         )
 
+    def contains(self, position: tuple[int, int]) -> bool:
+        return (
+            self.x <= position[0] < self.x + self.width
+            and self.y <= position[1] < self.y + self.height
+        )
+
+
+def layout_fingerprint(monitors: Iterable[Monitor]) -> str:
+    return "+".join(
+        sorted(
+            f"{monitor.name}:{monitor.width}x{monitor.height}@{monitor.scale:g}"
+            for monitor in monitors
+        )
+    )
+
 
 class StateStore:
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, max_placements: int, max_layouts: int) -> None:
         self.path = path
+        self.max_placements = max_placements
+        self.max_layouts = max_layouts
+        self.persisted: bytes | None = None
+        self.writes = 0
+        self.skipped_writes = 0
 
     def exists(self) -> bool:
         return self.path.exists()
 
-    def load(self) -> LegacyPosition | Placement:
+    def new_state(self) -> PlacementState:
+        return PlacementState(self.max_placements, self.max_layouts)
+
+    def load(self) -> PlacementState:
         try:
-            with self.path.open(encoding="utf-8") as handle:
-                raw = json.load(handle)
+            content = self.path.read_bytes()
         except OSError as error:
             raise PipStateError(
                 f"cannot read state file {self.path}: {error}"
             ) from error
-        except json.JSONDecodeError as error:
+        try:
+            raw = json.loads(content)
+        except (json.JSONDecodeError, UnicodeDecodeError) as error:
             raise PipStateError(
                 f"invalid JSON in state file {self.path}: {error}"
             ) from error
+        state = self._parse(raw, self.path)
+        self.persisted = content
+        return state
 
+    @staticmethod
+    def _serialize(state: PlacementState) -> bytes:
+        return (
+            json.dumps(state.to_json(), ensure_ascii=False, sort_keys=True) + "\n"
+        ).encode("utf-8")
+
+    def _parse(self, raw: Any, source: Path) -> PlacementState:
         if not isinstance(raw, dict):
-            raise PipStateError(f"state file {self.path} must contain a JSON object")
+            raise PipStateError(f"state file {source} must contain a JSON object")
         version = raw.get("version")
         if version not in SUPPORTED_STATE_VERSIONS:
             raise PipStateError(
-                f"state file {self.path} has unsupported version {version!r}"
+                f"state file {source} has unsupported version {version!r}"
             )
 
+        state = self.new_state()
+        if version in (1, 2, 3):
+            state.put(
+                LEGACY_LAYOUT,
+                DEFAULT_IDENTITY,
+                self._parse_placement(raw, source, version == 2),
+            )
+            return state
+        if version == 4:
+            self._parse_placements(state, LEGACY_LAYOUT, raw, source)
+            return state
+
+        layouts = raw.get("layouts")
+        if not isinstance(layouts, list):
+            raise PipStateError(f"state file {source} has invalid layouts")
+        for entry in reversed(layouts):
+            layout = entry.get("layout") if isinstance(entry, dict) else None
+            if not isinstance(layout, str):
+                raise PipStateError(f"state file {source} has an invalid layout")
+            self._parse_placements(state, layout, entry, source)
+        return state
+
+    def _parse_placements(
+        self, state: PlacementState, layout: str, raw: dict[str, Any], source: Path
+    ) -> None:
+        placements = raw.get("placements")
+        if not isinstance(placements, list):
+            raise PipStateError(f"state file {source} has invalid placements")
+        for entry in reversed(placements):
+            if not isinstance(entry, dict):
+                raise PipStateError(f"state file {source} has an invalid placement")
+            window_class = entry.get("class")
+            title = entry.get("title")
+            order = entry.get("order")
+            if (
+                not isinstance(window_class, str)
+                or not isinstance(title, str)
+                or type(order) is not int
+                or order < 0
+            ):
+                raise PipStateError(
+                    f"state file {source} has an invalid window identity"
+                )
+            state.put(
+                layout,
+                WindowIdentity(window_class, title, order),
+                self._parse_placement(entry, source, "width" not in entry),
+            )
+
+    @staticmethod
+    def _parse_placement(
+        raw: dict[str, Any], source: Path, legacy: bool
+    ) -> LegacyPosition | Placement:
         monitor = raw.get("monitor")
         if not isinstance(monitor, str) or not monitor:
-            raise PipStateError(f"state file {self.path} has an invalid monitor")
+            raise PipStateError(f"state file {source} has an invalid monitor")
 
         values: dict[str, int] = {}
         for key in ("x", "y"):
             value = raw.get(key)
             if type(value) is not int:
-                raise PipStateError(f"state file {self.path} has an invalid {key}")
+                raise PipStateError(f"state file {source} has an invalid {key}")
             values[key] = value
 
-        if version == 2:
+        if legacy:
             return LegacyPosition(monitor=monitor, **values)
 
         width = raw.get("width")
         if type(width) is not int or width <= 0:
-            raise PipStateError(f"state file {self.path} has an invalid width")
+            raise PipStateError(f"state file {source} has an invalid width")
 
         return Placement(monitor=monitor, width=width, **values)
 
-    def save(self, placement: Placement) -> None:
+    @timed_phase("save")
+    def save(self, state: PlacementState) -> None:
+        payload = self._serialize(state)
+        if payload == self.persisted:
+            self.skipped_writes += 1
+            return
+        self._write_atomic(payload)
+        self.writes += 1
+
+    def _write_atomic(self, payload: bytes) -> None:
         self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
         fd, temporary_name = tempfile.mkstemp(
             dir=self.path.parent,
             prefix=f".{self.path.name}.",
-            text=True,
         )
         temporary_path = Path(temporary_name)
 
         try:
             os.fchmod(fd, 0o600)
-            with os.fdopen(fd, "w", encoding="utf-8") as handle:
-                json.dump(
-                    placement.to_json(), handle, ensure_ascii=False, sort_keys=True
-                )
-                handle.write("\n")
+            with os.fdopen(fd, "wb") as handle:
+                handle.write(payload)
                 handle.flush()
                 os.fsync(handle.fileno())
             os.replace(temporary_path, self.path)
         finally:
             temporary_path.unlink(missing_ok=True)
+        self.persisted = payload
+
+    def write_summary(self) -> str:
+        return (
+            f"performed {self.writes} state writes, skipped {self.skipped_writes}"
+        )
 
     def reset(self) -> None:
         self.path.unlink(missing_ok=True)
+        self.persisted = None
+
+    def sync_deadline(self) -> float | None:
+        return None
+
+    def sync(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def journal_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.journal")
+
+
+class JournalStateStore(StateStore):
+    def __init__(
+        self,
+        path: Path,
+        max_placements: int,
+        max_layouts: int,
+        fsync_interval: float,
+        max_bytes: int,
+    ) -> None:
+        super().__init__(path, max_placements, max_layouts)
+        self.journal_path = journal_path(path)
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.journal_fd: int | None = None
+        self.journal_size = 0
+        self.journaled: bytes | None = None
+        self.last_sync = -math.inf
+        self.unsynced = False
+        self.leftover = False
+        self.tail: tuple[bytes, PlacementState] | None = None
+        self.tail_read = False
+
+    def exists(self) -> bool:
+        return super().exists() or self._journal_tail() is not None
+
+    def load(self) -> PlacementState:
+        tail = self._journal_tail()
+        if tail is None:
+            state = super().load()
+            self.journaled = self.persisted
+        else:
+            self.journaled, state = tail
+        # A journal left by a crash is folded in now instead of being replayed on every start. / クラッシュで残ったジャーナルは起動のたびに再生せず、ここで畳み込む。
+        if self.leftover:
+            self.compact()
+        return state
+
+    def _journal_tail(self) -> tuple[bytes, PlacementState] | None:
+        if self.tail_read:
+            return self.tail
+        try:
+            data = self.journal_path.read_bytes()
+        except FileNotFoundError:
+            data = b""
+        except OSError as error:
+            raise PipStateError(
+                f"cannot read state journal {self.journal_path}: {error}"
+            ) from error
+        self.leftover = bool(data)
+        self.tail_read = True
+        for line in reversed(data.splitlines()):
+            try:
+                raw = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            self.tail = line + b"\n", self._parse(raw, self.journal_path)
+            break
+        return self.tail
+
+    def _journal(self) -> int:
+        if self.journal_fd is None:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            try:
+                self.journal_fd = os.open(
+                    self.journal_path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+                    0o600,
+                )
+            except OSError as error:
+                raise PipStateError(
+                    f"cannot open state journal {self.journal_path}: {error}"
+                ) from error
+            self.journal_size = os.fstat(self.journal_fd).st_size
+        return self.journal_fd
+
+    @timed_phase("save")
+    def save(self, state: PlacementState) -> None:
+        record = self._serialize(state)
+        if record == self.journaled:
+            self.skipped_writes += 1
+            return
+        fd = self._journal()
+        os.write(fd, record)
+        self.journal_size += len(record)
+        self.journaled = record
+        self.writes += 1
+        self.unsynced = True
+        if self.journal_size > self.max_bytes:
+            self.compact()
+        elif time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync_deadline(self) -> float | None:
+        if not self.unsynced:
+            return None
+        return self.last_sync + self.fsync_interval
+
+    def sync(self) -> None:
+        if self.journal_fd is not None and self.unsynced:
+            os.fsync(self.journal_fd)
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def compact(self) -> None:
+        latest = self.journaled
+        if latest is None:
+            tail = self._journal_tail()
+            latest = None if tail is None else tail[0]
+        if latest is not None and latest != self.persisted:
+            self._write_atomic(latest)
+        fd = self._journal()
+        os.ftruncate(fd, 0)
+        self.journal_size = 0
+        self.leftover = False
+        self.tail = None
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def reset(self) -> None:
+        self.close_journal()
+        self.journaled = None
+        self.unsynced = False
+        self.leftover = False
+        self.tail = None
+        self.journal_path.unlink(missing_ok=True)
+        super().reset()
+
+    def close_journal(self) -> None:
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            self.journal_fd = None
+
+    def close(self) -> None:
+        try:
+            if self.journal_size > 0:
+                self.compact()
+        finally:
+            self.close_journal()
+
+
+@dataclass(frozen=True)
+class Restore:
+    address: str
+    monitor: Monitor
+    placement: Placement
+    size: tuple[int, int]
 
 
 class Hyprland:
-    def __init__(self, executable: str) -> None:
+    def __init__(self, executable: str, socket_path: Path | None = None) -> None:
         self.executable = executable
+        self.socket_path = socket_path
+        self.instance: str | None = None
+        self.socket_failing = False
+        self.calls: dict[str, LatencyHistogram] = {}
+        self.recent_calls: deque[tuple[float, str, float]] = deque(maxlen=256)
+        self.recorder: TraceRecorder | None = None
+
+    def retarget(self, signature: str) -> None:
+        self.instance = signature
+        if self.socket_path is not None:
+            self.socket_path = request_socket_path(signature)
+        self.socket_failing = False
 
     def _run(self, *arguments: str) -> str:
-        command = [self.executable, *arguments]
+        instance = () if self.instance is None else ("--instance", self.instance)
+        command = [self.executable, *instance, *arguments]
         try:
             result = subprocess.run(
                 command,
@@ -200,8 +713,69 @@ class Hyprland:
             raise PipStateError(f"{' '.join(command)} failed: {detail}") from error
         return result.stdout
 
+    def _request(self, request: str) -> str:
+        assert self.socket_path is not None
+        chunks: list[bytes] = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(REQUEST_TIMEOUT)
+            connection.connect(str(self.socket_path))
+            connection.sendall(request.encode("utf-8"))
+            while chunk := connection.recv(65536):
+                chunks.append(chunk)
+        try:
+            return b"".join(chunks).decode("utf-8")
+        except UnicodeDecodeError as error:
+            raise PipStateError(
+                f"Hyprland request socket returned invalid UTF-8: {error}"
+            ) from error
+
+    def _call(self, request: str, *arguments: str) -> str:
+        kind = "batch" if request.startswith("[[BATCH]]") else request
+        started = time.perf_counter()
+        try:
+            output = self._dispatch(request, *arguments)
+            if self.recorder is not None:
+                self.recorder.write(request=request, response=output)
+            return output
+        finally:
+            elapsed = time.perf_counter() - started
+            self.calls.setdefault(kind, LatencyHistogram()).record(elapsed)
+            self.recent_calls.append((elapsed, kind, time.time()))
+
+    def slowest_calls(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "request": kind,
+                "ms": round(elapsed * 1000, 3),
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(at)),
+            }
+            for elapsed, kind, at in sorted(self.recent_calls, reverse=True)[
+                :SLOWEST_CALLS
+            ]
+        ]
+
+    def _dispatch(self, request: str, *arguments: str) -> str:
+        if self.socket_path is None:
+            return self._run(*arguments)
+        try:
+            output = self._request(request)
+        except OSError as error:
+            if not self.socket_failing:
+                log(
+                    f"cannot use Hyprland request socket {self.socket_path}: "
+                    f"{error}; falling back to {self.executable}"
+                )
+                self.socket_failing = True
+        else:
+            self.socket_failing = False
+            return output
+        try:
+            return self._run(*arguments)
+        except PipStateError as error:
+            raise HyprlandUnavailable(str(error)) from error
+
     def _run_json(self, command: str) -> list[dict[str, Any]]:
-        output = self._run(command, "-j")
+        output = self._call(f"j/{command}", command, "-j")
         try:
             value = json.loads(output)
         except json.JSONDecodeError as error:
@@ -212,31 +786,543 @@ class Hyprland:
             raise PipStateError(f"hyprctl {command} did not return a JSON array")
         return value
 
+    def _batch(self, batch: str) -> str:
+        return self._call(f"[[BATCH]]{batch}", "--batch", batch)
+
     def clients(self) -> list[dict[str, Any]]:
         return self._run_json("clients")
 
     def monitors(self) -> list[dict[str, Any]]:
         return self._run_json("monitors")
 
-    def restore(
+    def restore(self, restores: list[Restore]) -> None:
+        commands: list[str] = []
+        for restore in restores:
+            selector = f"address:{restore.address}"
+            global_x = restore.monitor.x + restore.placement.x
+            global_y = restore.monitor.y + restore.placement.y
+            width, height = restore.size
+            commands.append(
+                f"dispatch resizewindowpixel exact {width} {height},{selector}"
+            )
+            commands.append(
+                f"dispatch movewindowpixel exact {global_x} {global_y},{selector}"
+            )
+        output = self._batch(" ; ".join(commands))
+        if any(line.lower().startswith("error") for line in output.splitlines()):
+            raise PipStateError(
+                f"hyprctl rejected PiP placement restore: {output.strip()}"
+            )
+
+    def add_window_rules(self, rules: list[str]) -> None:
+        batch = " ; ".join(f"keyword windowrulev2 {rule}" for rule in rules)
+        output = self._batch(batch)
+        if any(line.strip() not in ("", "ok") for line in output.splitlines()):
+            raise PipStateError(f"hyprctl rejected PiP window rules: {output.strip()}")
+
+
+def literal_pattern(value: str) -> str:
+    return "".join(
+        f"\\{character}" if character in REGEX_METACHARACTERS else character
+        for character in value
+    )
+
+
+def rule_selector(identity: WindowIdentity) -> str:
+    return (
+        f"class:^({literal_pattern(identity.window_class)})$,"
+        f"title:^({literal_pattern(identity.title)})$"
+    )
+
+
+@dataclass(frozen=True)
+class WindowRule:
+    name: str
+    classes: tuple[str, ...] | None = None
+    class_regex: str | None = None
+    titles: tuple[str, ...] | None = None
+    title_regex: str | None = None
+    floating: bool = True
+    debounce: float | None = None
+
+    @staticmethod
+    def _pattern(literals: tuple[str, ...] | None, regex: str | None) -> str:
+        if regex is not None:
+            return regex
+        if literals is not None:
+            return "|".join(re.escape(literal) for literal in literals)
+        return ".*"
+
+    def pattern(self) -> str:
+        return (
+            f"(?:{self._pattern(self.classes, self.class_regex)})\n"
+            f"(?:{self._pattern(self.titles, self.title_regex)})\\Z"
+        )
+
+
+DEFAULT_WINDOW_RULES = (
+    WindowRule(name="browser-pip", classes=("",), titles=tuple(sorted(PIP_TITLES))),
+)
+
+
+class WindowMatcher:
+    def __init__(self, rules: tuple[WindowRule, ...]) -> None:
+        self.rules = rules
+        self.literal: dict[tuple[str, str], tuple[int, WindowRule]] = {}
+        self.groups: dict[str, tuple[int, WindowRule]] = {}
+        self.separate: list[tuple[int, re.Pattern[str], WindowRule]] = []
+        self.first_pattern = len(rules)
+        alternatives: list[str] = []
+        for index, rule in enumerate(rules):
+            if rule.classes is not None and rule.titles is not None:
+                for window_class in rule.classes:
+                    for title in rule.titles:
+                        self.literal.setdefault((window_class, title), (index, rule))
+                continue
+            self.first_pattern = min(self.first_pattern, index)
+            pattern = self._compile(rule.pattern(), rule.name)
+            if pattern.groups:
+                # Groups and backreferences would clash or renumber once joined. / 結合するとグループ名の衝突や後方参照の番号ずれが起きる。
+                self.separate.append((index, pattern, rule))
+                continue
+            group = f"rule{index}"
+            self.groups[group] = (index, rule)
+            alternatives.append(f"(?P<{group}>{rule.pattern()})")
+        self.combined = (
+            self._compile("|".join(alternatives), "combined") if alternatives else None
+        )
+
+    @staticmethod
+    def _compile(pattern: str, name: str) -> re.Pattern[str]:
+        try:
+            return re.compile(pattern, re.MULTILINE)
+        except re.error as error:
+            raise PipStateError(f"invalid PiP window rule {name}: {error}") from error
+
+    def match(self, window_class: Any, title: Any) -> WindowRule | None:
+        if not isinstance(window_class, str) or not isinstance(title, str):
+            return None
+        # The first matching rule in file order wins, whichever way it is matched. / 照合方法に関係なく、ファイル順で最初に一致した規則を採る。
+        first, rule = self.literal.get((window_class, title), (len(self.rules), None))
+        if first < self.first_pattern:
+            return rule
+        text = f"{window_class}\n{title.replace(chr(10), ' ')}"
+        found = None if self.combined is None else self.combined.match(text)
+        if found is not None:
+            index, candidate = self.groups[found.lastgroup or ""]
+            if index < first:
+                first, rule = index, candidate
+        for index, pattern, candidate in self.separate:
+            if index > first:
+                break
+            if pattern.match(text):
+                return candidate
+        return rule
+
+    def literal_identities(self) -> list[tuple[str, str]]:
+        return sorted(self.literal)
+
+
+def parse_rule_text(
+    raw: Any, field: str, source: Path
+) -> tuple[tuple[str, ...] | None, str | None]:
+    if raw is None:
+        return None, None
+    if isinstance(raw, str):
+        return (raw,), None
+    if isinstance(raw, list) and raw and all(isinstance(item, str) for item in raw):
+        return tuple(raw), None
+    if isinstance(raw, dict) and set(raw) == {"regex"} and isinstance(raw["regex"], str):
+        try:
+            re.compile(raw["regex"])
+        except re.error as error:
+            raise PipStateError(
+                f"rules file {source} has an invalid {field} regex: {error}"
+            ) from error
+        # Rules are embedded in a larger pattern, where global flags such as (?i) are rejected. / 規則は大きな正規表現に埋め込まれるため、(?i) のような全体フラグは使えない。
+        try:
+            re.compile(f"(?:{raw['regex']})")
+        except re.error as error:
+            raise PipStateError(
+                f"rules file {source} has a {field} regex that cannot be embedded: "
+                f"{error}; use a scoped flag group such as (?i:...) instead"
+            ) from error
+        return None, raw["regex"]
+    raise PipStateError(
+        f"rules file {source} has an invalid {field}: expected a string, "
+        "a list of strings or {\"regex\": ...}"
+    )
+
+
+def load_window_matcher(path: Path) -> WindowMatcher:
+    return WindowMatcher(load_window_rules(path))
+
+
+def load_window_rules(path: Path) -> tuple[WindowRule, ...]:
+    try:
+        content = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return DEFAULT_WINDOW_RULES
+    except OSError as error:
+        raise PipStateError(f"cannot read rules file {path}: {error}") from error
+    try:
+        raw = json.loads(content)
+    except json.JSONDecodeError as error:
+        raise PipStateError(f"invalid JSON in rules file {path}: {error}") from error
+
+    entries = raw.get("rules") if isinstance(raw, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise PipStateError(f"rules file {path} must contain a non-empty rules list")
+    rules: list[WindowRule] = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise PipStateError(f"rules file {path} has an invalid rule #{index}")
+        name = entry.get("name", f"rule-{index}")
+        floating = entry.get("floating", True)
+        debounce = entry.get("debounce")
+        if not isinstance(name, str) or not name:
+            raise PipStateError(f"rules file {path} has an invalid name in rule #{index}")
+        if not isinstance(floating, bool):
+            raise PipStateError(f"rules file {path} has an invalid floating in {name}")
+        if debounce is not None and (
+            isinstance(debounce, bool)
+            or not isinstance(debounce, (int, float))
+            or not math.isfinite(debounce)
+            or debounce <= 0
+        ):
+            raise PipStateError(f"rules file {path} has an invalid debounce in {name}")
+        classes, class_regex = parse_rule_text(entry.get("class"), "class", path)
+        titles, title_regex = parse_rule_text(entry.get("title"), "title", path)
+        if classes is None and class_regex is None and titles is None and title_regex is None:
+            raise PipStateError(f"rules file {path} rule {name} matches every window")
+        rules.append(
+            WindowRule(
+                name=name,
+                classes=classes,
+                class_regex=class_regex,
+                titles=titles,
+                title_regex=title_regex,
+                floating=floating,
+                debounce=None if debounce is None else float(debounce),
+            )
+        )
+    return tuple(rules)
+
+
+class WindowTable:
+    def __init__(self, hyprland: Hyprland, matcher: WindowMatcher) -> None:
+        self.hyprland = hyprland
+        self.matcher = matcher
+        self.clients: dict[str, dict[str, Any]] = {}
+        self.matched: dict[str, WindowRule] = {}
+        self.incomplete: set[str] = set()
+        self.sequence: dict[str, int] = {}
+        self.next_sequence = 0
+        self.workspaces: set[str] = set()
+        self.stale = True
+
+    def _index(self, address: str, client: dict[str, Any]) -> None:
+        if address not in self.sequence:
+            self.sequence[address] = self.next_sequence
+            self.next_sequence += 1
+        self.clients[address] = client
+        workspace = client.get("workspace")
+        if isinstance(workspace, dict) and isinstance(workspace.get("name"), str):
+            self.workspaces.add(workspace["name"])
+        rule = self.matcher.match(client.get("class"), client.get("title"))
+        if rule is None:
+            self.matched.pop(address, None)
+        else:
+            self.matched[address] = rule
+
+    def _unindex(self, address: str) -> dict[str, Any] | None:
+        self.matched.pop(address, None)
+        return self.clients.pop(address, None)
+
+    def set_matcher(self, matcher: WindowMatcher) -> None:
+        self.matcher = matcher
+        self.stale = True
+
+    def invalidate(self) -> None:
+        self.stale = True
+
+    def forget_geometry(self, address: str) -> None:
+        if address in self.clients:
+            self.incomplete.add(address)
+
+    def forget_pip_geometry(self, monitor_ids: set[int]) -> None:
+        self.incomplete.update(
+            address
+            for address in self.matched
+            if self.clients[address].get("monitor") in monitor_ids
+        )
+
+    def resync(self) -> None:
+        clients = self.hyprland.clients()
+        self.clients = {}
+        self.matched = {}
+        self.incomplete = set()
+        self.sequence = {}
+        self.workspaces = set()
+        for client in clients:
+            address = client.get("address")
+            if isinstance(address, str) and address:
+                self._index(address, client)
+        self.stale = False
+
+    def update_geometry(
         self,
         address: str,
-        monitor: Monitor,
-        placement: Placement,
-        window_size: tuple[int, int],
+        monitor_id: int,
+        position: tuple[int, int],
+        size: tuple[int, int],
     ) -> None:
-        selector = f"address:{address}"
-        global_x = monitor.x + placement.x
-        global_y = monitor.y + placement.y
-        batch = (
-            f"dispatch resizewindowpixel exact {window_size[0]} {window_size[1]},{selector} ; "
-            f"dispatch movewindowpixel exact {global_x} {global_y},{selector}"
-        )
-        output = self._run("--batch", batch)
-        if any(line.lower().startswith("error") for line in output.splitlines()):
+        client = self.clients.get(address)
+        if client is None:
+            return
+        client["monitor"] = monitor_id
+        client["at"] = [position[0], position[1]]
+        client["size"] = [size[0], size[1]]
+
+    def rule_for(self, address: str) -> WindowRule | None:
+        return self.matched.get(address)
+
+    def apply_event(self, name: str, payload: str) -> bool:
+        if self.stale:
+            return True
+        if name == "openwindow":
+            fields = self._split_open_window(payload)
+            if fields is None:
+                self.stale = True
+                return True
+            address, workspace, window_class, title = fields
+            self._unindex(address)
+            self._index(
+                address,
+                {
+                    "address": address,
+                    "workspace": {"name": workspace},
+                    "class": window_class,
+                    "title": title,
+                    "mapped": True,
+                    "hidden": False,
+                },
+            )
+            self.incomplete.add(address)
+            return address in self.matched
+
+        address = event_address(payload)
+        client = self.clients.get(address)
+        if client is None:
+            self.stale = True
+            return True
+        relevant = address in self.matched
+
+        if name == "closewindow":
+            self._unindex(address)
+            self.incomplete.discard(address)
+            self.sequence.pop(address, None)
+            return relevant
+        if name == "windowtitlev2":
+            client["title"] = payload.split(",", 1)[1] if "," in payload else ""
+            self._index(address, client)
+            return relevant or address in self.matched
+        if name == "movewindowv2":
+            self.incomplete.add(address)
+            return relevant
+        if name == "changefloatingmode":
+            client["floating"] = payload.rsplit(",", 1)[-1] == "1"
+            return relevant
+        return False
+
+    def _split_open_window(self, payload: str) -> tuple[str, str, str, str] | None:
+        address, _, rest = payload.partition(",")
+        if rest.count(",") == 2:
+            workspace, window_class, title = rest.split(",")
+            return "0x" + address, workspace, window_class, title
+        # Workspace names and titles may both contain commas; only a known workspace settles it. / ワークスペース名とタイトルの両方にカンマが入りうるため、既知のワークスペース名でのみ確定する。
+        workspaces = [
+            workspace for workspace in self.workspaces if rest.startswith(workspace + ",")
+        ]
+        if len(workspaces) != 1:
+            return None
+        window_class, separator, title = rest[len(workspaces[0]) + 1 :].partition(",")
+        if not separator:
+            return None
+        return "0x" + address, workspaces[0], window_class, title
+
+    def pip_clients(self) -> list[dict[str, Any]]:
+        if self.stale:
+            self.resync()
+        candidates = self._pip_candidates()
+        if any(client["address"] in self.incomplete for client in candidates):
+            self.resync()
+            candidates = self._pip_candidates()
+        return candidates
+
+    def _pip_candidates(self) -> list[dict[str, Any]]:
+        return [
+            client
+            for address in sorted(self.matched, key=self.sequence.__getitem__)
+            if (client := self.clients[address]).get("mapped") is True
+            and client.get("hidden") is not True
+        ]
+
+
+class MonitorRegistry:
+    def __init__(self, hyprland: Hyprland) -> None:
+        self.hyprland = hyprland
+        self.by_id: dict[int, Monitor] = {}
+        self.by_name: dict[str, Monitor] = {}
+        self.added: set[str] = set()
+        self.fingerprint = ""
+        self.unverified = False
+        self.stale = True
+        self.refreshes = 0
+        self.moved: set[int] = set()
+
+    def refresh(self) -> None:
+        monitors = [Monitor.from_hyprland(raw) for raw in self.hyprland.monitors()]
+        if not monitors:
+            raise PipStateError("Hyprland reported no monitors")
+        by_id = {monitor.id: monitor for monitor in monitors}
+        self.moved.update(
+            monitor_id
+            for monitor_id, monitor in self.by_id.items()
+            if by_id.get(monitor_id) != monitor
+        )
+        self.by_id = by_id
+        self.by_name = {monitor.name: monitor for monitor in monitors}
+        self.fingerprint = layout_fingerprint(monitors)
+        self.added = set()
+        self.unverified = False
+        self.stale = False
+        self.refreshes += 1
+
+    def invalidate(self) -> None:
+        self.stale = True
+
+    def _current(self) -> None:
+        if self.stale or self.added:
+            self.refresh()
+
+    def apply_event(self, name: str, payload: str) -> None:
+        if name == "configreloaded":
+            self.stale = True
+            return
+        if name == "monitoraddedv2":
+            monitor_id, _, rest = payload.partition(",")
+            monitor_name = rest.partition(",")[0]
+            known = self.by_name.get(monitor_name)
+            if known is None or str(known.id) != monitor_id:
+                self.added.add(monitor_name)
+        elif name == "monitoradded":
+            if payload not in self.by_name:
+                self.added.add(payload)
+        else:
+            if name == "monitorremovedv2":
+                payload = payload.partition(",")[2].partition(",")[0]
+            monitor = self.by_name.pop(payload, None)
+            self.added.discard(payload)
+            if monitor is not None:
+                del self.by_id[monitor.id]
+                self.moved.add(monitor.id)
+                self.fingerprint = layout_fingerprint(self.by_id.values())
+                self.unverified = True
+
+    def get(self, monitor_id: int) -> Monitor | None:
+        self._current()
+        if monitor_id not in self.by_id:
+            self.refresh()
+        return self.by_id.get(monitor_id)
+
+    def named(self, name: str) -> Monitor | None:
+        self._current()
+        return self.by_name.get(name)
+
+    def layout(self) -> str:
+        self._current()
+        return self.fingerprint
+
+    def take_moved(self) -> set[int]:
+        moved, self.moved = self.moved, set()
+        return moved
+
+    def connected(self) -> set[str]:
+        self._current()
+        return set(self.by_name)
+
+    def _containing(self, position: tuple[int, int]) -> Monitor | None:
+        for monitor in self.by_id.values():
+            if monitor.contains(position):
+                return monitor
+        return None
+
+    def verify(self, monitor: Monitor, position: tuple[int, int]) -> Monitor:
+        if not self.unverified or monitor.contains(position):
+            return monitor
+        # Removing an output may rearrange the rest. / 出力の取り外しで残りの配置が変わることがある。
+        self.refresh()
+        return self.by_id.get(monitor.id, monitor)
+
+    def at(self, position: tuple[int, int]) -> Monitor | None:
+        self._current()
+        monitor = self._containing(position)
+        if monitor is None and self.unverified:
+            self.refresh()
+            monitor = self._containing(position)
+        return monitor
+
+
+class PollSchedule:
+    def __init__(
+        self,
+        initial: float,
+        fast: float,
+        ceiling: float,
+        idle_samples: int,
+    ) -> None:
+        if fast > ceiling:
             raise PipStateError(
-                f"hyprctl rejected PiP placement restore: {output.strip()}"
+                f"fast poll interval {fast:g}s exceeds the ceiling {ceiling:g}s"
             )
+        self.initial = min(max(initial, fast), ceiling)
+        self.fast = fast
+        self.ceiling = ceiling
+        self.idle_samples = idle_samples
+        self.interval = self.initial
+        self.still_samples = 0
+
+    def reset(self) -> None:
+        self.interval = self.initial
+        self.still_samples = 0
+
+    def observe(self, moved: bool) -> None:
+        if moved:
+            if self.interval != self.fast:
+                log(f"PiP is moving; polling every {self.fast:g}s")
+            self.interval = self.fast
+            self.still_samples = 0
+            return
+        self.still_samples += 1
+        if self.still_samples < self.idle_samples or self.interval == self.ceiling:
+            return
+        self.interval = min(self.interval * 2, self.ceiling)
+        if self.interval == self.ceiling:
+            log(f"PiP is idle; polling every {self.ceiling:g}s")
+
+
+@dataclass
+class TrackedWindow:
+    address: str
+    identity: WindowIdentity
+    last_sample: Placement
+    last_size: tuple[int, int]
+    last_saved: Placement
+    debounce: float
+    layout: str
+    pending: Placement | None = None
+    pending_since: float | None = None
 
 
 class PipTracker:
@@ -245,46 +1331,60 @@ class PipTracker:
         hyprland: Hyprland,
         store: StateStore,
         save_debounce: float,
+        poll_schedule: PollSchedule,
+        rules_file: Path,
     ) -> None:
         self.hyprland = hyprland
         self.store = store
         self.save_debounce = save_debounce
-        self.monitors: dict[int, Monitor] = {}
-        self.active_address: str | None = None
-        self.blocked_address: str | None = None
-        self.last_saved: Placement | None = None
-        self.pending: Placement | None = None
-        self.pending_since: float | None = None
-        self.multiple_error_active = False
-
-    def refresh_monitors(self) -> None:
-        monitors = [Monitor.from_hyprland(raw) for raw in self.hyprland.monitors()]
-        self.monitors = {monitor.id: monitor for monitor in monitors}
-        if not self.monitors:
-            raise PipStateError("Hyprland reported no monitors")
+        self.poll_schedule = poll_schedule
+        self.rules_file = rules_file
+        self.windows = WindowTable(
+            hyprland, load_window_matcher(rules_file)
+        )
+        self.monitors = MonitorRegistry(hyprland)
+        self.state: PlacementState | None = None
+        self.tracked: dict[str, TrackedWindow] = {}
+        self.blocked: set[str] = set()
+        self.last_sizes: dict[WindowIdentity, tuple[int, int]] = {}
+        self.injected_rules: dict[
+            WindowIdentity, tuple[Placement, tuple[int, int] | None]
+        ] = {}
+
+    def reload_rules(self) -> None:
+        try:
+            matcher = load_window_matcher(self.rules_file)
+        except PipStateError as error:
+            log(f"cannot reload PiP window rules, keeping the previous ones: {error}")
+            return
+        if matcher.rules == self.windows.matcher.rules:
+            return
+        self.windows.set_matcher(matcher)
+        log(f"reloaded {len(matcher.rules)} PiP window rules from {self.rules_file}")
 
+    @timed_phase("pip_clients")
     def _pip_clients(self) -> list[dict[str, Any]]:
-        return [
-            client
-            for client in self.hyprland.clients()
-            if client.get("class") == ""
-            and client.get("title") in PIP_TITLES
-            and client.get("mapped") is True
-            and client.get("hidden") is not True
-        ]
+        return self.windows.pip_clients()
+
+    def _placements(self) -> PlacementState:
+        if self.state is None:
+            self.state = (
+                self.store.load() if self.store.exists() else self.store.new_state()
+            )
+        return self.state
 
     def _monitor_for_client(self, client: dict[str, Any]) -> Monitor:
         monitor_id = client.get("monitor")
         if type(monitor_id) is not int:
             raise PipStateError("PiP window has an invalid monitor id")
-        if monitor_id not in self.monitors:
-            self.refresh_monitors()
-        try:
-            return self.monitors[monitor_id]
-        except KeyError as error:
-            raise PipStateError(
-                f"PiP window refers to unknown monitor id {monitor_id}"
-            ) from error
+        monitor = self.monitors.get(monitor_id)
+        if monitor is None:
+            raise PipStateError(f"PiP window refers to unknown monitor id {monitor_id}")
+        return monitor
+
+    @staticmethod
+    def _center(position: tuple[int, int], size: tuple[int, int]) -> tuple[int, int]:
+        return position[0] + size[0] // 2, position[1] + size[1] // 2
 
     def _placement_for_client(self, client: dict[str, Any]) -> Placement:
         monitor = self._monitor_for_client(client)
@@ -292,6 +1392,7 @@ class PipTracker:
         if not self._integer_pair(position):
             raise PipStateError("PiP window has an invalid position")
         size = self._size_for_client(client)
+        monitor = self.monitors.verify(monitor, self._center(position, size))
         return Placement(
             monitor=monitor.name,
             x=position[0] - monitor.x,
@@ -316,12 +1417,13 @@ class PipTracker:
         )
 
     def _monitor_by_name(self, name: str) -> Monitor:
-        for monitor in self.monitors.values():
-            if monitor.name == name:
-                return monitor
-        raise PipStateError(f"saved PiP monitor {name!r} is not connected")
+        monitor = self.monitors.named(name)
+        if monitor is None:
+            raise PipStateError(f"saved PiP monitor {name!r} is not connected")
+        return monitor
 
     @staticmethod
+    @timed_phase("fit_to_monitor")
     def _fit_to_monitor(
         placement: Placement,
         monitor: Monitor,
@@ -351,22 +1453,49 @@ class PipTracker:
         )
         return fitted, (target_width, target_height)
 
-    def _initialize(self, client: dict[str, Any]) -> None:
+    def _identity_for_client(
+        self, client: dict[str, Any], rule: WindowRule
+    ) -> WindowIdentity:
+        window_class = str(client.get("class", ""))
+        title = rule.name if rule.titles is None else str(client.get("title", ""))
+        taken = {
+            window.identity.order
+            for window in self.tracked.values()
+            if window.identity.window_class == window_class
+            and window.identity.title == title
+        }
+        order = 0
+        while order in taken:
+            order += 1
+        return WindowIdentity(window_class, title, order)
+
+    def _initialize(
+        self, client: dict[str, Any], identity: WindowIdentity | None = None
+    ) -> Restore | None:
         address = client.get("address")
         if not isinstance(address, str) or not address:
             raise PipStateError("PiP window has an invalid address")
-        if client.get("floating") is not True:
+        rule = self.windows.rule_for(address)
+        if rule is None:
+            raise PipStateError(f"PiP window {address} matches no rule")
+        if rule.floating and client.get("floating") is not True:
             raise PipStateError(f"PiP window {address} is not floating")
 
+        if identity is None:
+            identity = self._identity_for_client(client, rule)
         current_size = self._size_for_client(client)
-        if not self.store.exists():
+        layout = self.monitors.layout()
+        state = self._placements()
+        saved = state.get(layout, identity, self.monitors.connected())
+        restore = None
+        if saved is None:
             placement = self._placement_for_client(client)
-            self.store.save(placement)
+            state.put(layout, identity, placement)
+            self.store.save(state)
             log(
                 f"saved initial PiP position and width on {placement.monitor}"
             )
         else:
-            saved = self.store.load()
             if isinstance(saved, LegacyPosition):
                 saved = Placement(
                     monitor=saved.monitor,
@@ -388,181 +1517,1464 @@ class PipTracker:
                     "adjusted saved PiP position and width to fit monitor "
                     f"{monitor.name}: {saved} -> {placement}"
                 )
-            self.hyprland.restore(address, monitor, placement, target_size)
-            self.store.save(placement)
+            target_position = [monitor.x + placement.x, monitor.y + placement.y]
+            if (
+                client.get("monitor") == monitor.id
+                and client.get("at") == target_position
+                and tuple(client.get("size", ())) == target_size
+            ):
+                log(f"PiP window rules placed the window on {placement.monitor}")
+                current_size = target_size
+                state.put(layout, identity, placement)
+            else:
+                restore = Restore(address, monitor, placement, target_size)
+
+        self.tracked[address] = TrackedWindow(
+            address=address,
+            identity=identity,
+            last_sample=placement,
+            last_size=current_size,
+            last_saved=placement,
+            debounce=self.save_debounce if rule.debounce is None else rule.debounce,
+            layout=layout,
+        )
+        self.last_sizes[identity] = current_size
+        return restore
+
+    def _restore(self, restores: list[Restore]) -> None:
+        if not restores:
+            return
+        try:
+            self.hyprland.restore(restores)
+        except PipStateError as error:
+            log(f"cannot restore PiP placement: {error}")
+            for restore in restores:
+                self._release(restore.address)
+                self.blocked.add(restore.address)
+            return
+        state = self._placements()
+        for restore in restores:
+            window = self.tracked[restore.address]
+            window.last_size = restore.size
+            self.last_sizes[window.identity] = restore.size
+            state.put(window.layout, window.identity, restore.placement)
+            self.windows.update_geometry(
+                restore.address,
+                restore.monitor.id,
+                (
+                    restore.monitor.x + restore.placement.x,
+                    restore.monitor.y + restore.placement.y,
+                ),
+                restore.size,
+            )
             log(
-                f"restored PiP position and width on {placement.monitor}"
+                f"restored PiP position and width on {restore.placement.monitor}"
             )
 
-        self.active_address = address
-        self.blocked_address = None
-        self.last_saved = placement
-        self.pending = None
-        self.pending_since = None
-
-    def _flush_pending(self) -> None:
-        if self.pending is None:
+    def _flush(self, windows: list[TrackedWindow]) -> None:
+        windows = [window for window in windows if window.pending is not None]
+        if not windows:
+            return
+        state = self._placements()
+        for window in windows:
+            assert window.pending is not None
+            state.put(window.layout, window.identity, window.pending)
+        self.store.save(state)
+        for window in windows:
+            assert window.pending is not None
+            window.last_saved = window.pending
+            log(f"saved PiP position and width on {window.pending.monitor}")
+            window.pending = None
+            window.pending_since = None
+
+    def _release(self, address: str) -> None:
+        window = self.tracked.get(address)
+        if window is None:
             return
-        self.store.save(self.pending)
-        self.last_saved = self.pending
-        log(f"saved PiP position and width on {self.pending.monitor}")
-        self.pending = None
-        self.pending_since = None
-
-    def _clear_active(self) -> None:
-        self._flush_pending()
-        self.active_address = None
-        self.last_saved = None
-        self.pending = None
-        self.pending_since = None
-
-    def _track(self, client: dict[str, Any], now: float) -> None:
+        self._flush([window])
+        del self.tracked[address]
+        self.sync_window_rules()
+
+    def _track(self, window: TrackedWindow, client: dict[str, Any], now: float) -> bool:
         placement = self._placement_for_client(client)
-        if placement == self.last_saved:
-            self.pending = None
-            self.pending_since = None
+        moved = placement != window.last_sample
+        window.last_sample = placement
+        window.last_size = self._size_for_client(client)
+        self.last_sizes[window.identity] = window.last_size
+        self._track_placement(window, placement, now)
+        return moved
+
+    def _track_placement(
+        self, window: TrackedWindow, placement: Placement, now: float
+    ) -> None:
+        if placement == window.last_saved:
+            window.pending = None
+            window.pending_since = None
             return
-        if placement != self.pending:
-            self.pending = placement
-            self.pending_since = now
+        if placement != window.pending:
+            window.pending = placement
+            window.pending_since = now
             return
         if (
-            self.pending_since is not None
-            and now - self.pending_since >= self.save_debounce
+            window.pending_since is not None
+            and now - window.pending_since >= window.debounce
         ):
-            self._flush_pending()
-
-    def refresh(self) -> bool:
-        clients = self._pip_clients()
-        if not clients:
-            self._clear_active()
-            self.blocked_address = None
-            self.multiple_error_active = False
+            self._flush([window])
+
+    def refresh(self, resync: bool = False) -> bool:
+        if resync:
+            self.windows.invalidate()
+        # Only PiPs on a removed or rearranged monitor have moved. / 取り外しや再配置のあったモニター上の PiP だけが動いている。
+        layout = self.monitors.layout()
+        self.windows.forget_pip_geometry(self.monitors.take_moved())
+        clients = {
+            client["address"]: client
+            for client in self._pip_clients()
+            if isinstance(client.get("address"), str)
+        }
+        for address in [address for address in self.tracked if address not in clients]:
+            self._release(address)
+        self.blocked &= clients.keys()
+
+        now = time.monotonic()
+        moved = False
+        initialized = False
+        relayout = False
+        restores: list[Restore] = []
+        for address, client in clients.items():
+            if address in self.blocked:
+                continue
+            window = self.tracked.get(address)
+            identity = None
+            if window is not None and window.layout != layout:
+                # Keep the old layout's placement and recall the new one. / 旧レイアウトの配置を残し、新レイアウトの配置を呼び出す。
+                self._flush([window])
+                identity = window.identity
+                window = None
+                relayout = True
+            if window is None:
+                try:
+                    restore = self._initialize(client, identity)
+                except PipStateError as error:
+                    log(f"cannot initialize PiP placement: {error}")
+                    self.tracked.pop(address, None)
+                    self.blocked.add(address)
+                    continue
+                initialized = True
+                if restore is not None:
+                    restores.append(restore)
+                continue
+            try:
+                moved = self._track(window, client, now) or moved
+            except PipStateError as error:
+                log(f"cannot track PiP placement: {error}")
+                self._release(address)
+                self.blocked.add(address)
+
+        if initialized:
+            self._restore(restores)
+            self.store.save(self._placements())
+            self.poll_schedule.reset()
+        elif self.tracked:
+            self.poll_schedule.observe(moved)
+        if relayout:
+            self.sync_window_rules()
+        return bool(self.tracked)
+
+    def track_geometry(
+        self,
+        address: str,
+        position: tuple[int, int],
+        size: tuple[int, int],
+        now: float,
+    ) -> bool:
+        window = self.tracked.get(address)
+        if window is None or window.layout != self.monitors.layout():
             return False
-
-        if len(clients) > 1:
-            self._clear_active()
-            self.blocked_address = None
-            if not self.multiple_error_active:
-                log(f"refusing to manage {len(clients)} simultaneous PiP windows")
-                self.multiple_error_active = True
+        monitor = self.monitors.at(self._center(position, size))
+        if monitor is None or size[0] <= 0 or size[1] <= 0:
             return False
-
-        self.multiple_error_active = False
-        client = clients[0]
-        address = client.get("address")
-        if address == self.blocked_address:
+        placement = Placement(
+            monitor=monitor.name,
+            x=position[0] - monitor.x,
+            y=position[1] - monitor.y,
+            width=size[0],
+        )
+        self.windows.update_geometry(address, monitor.id, position, size)
+        window.last_sample = placement
+        window.last_size = size
+        self.last_sizes[window.identity] = size
+        self._track_placement(window, placement, now)
+        return True
+
+    def sync_window_rules(self, force: bool = False) -> None:
+        try:
+            state = self._placements()
+            layout = self.monitors.layout()
+            connected = self.monitors.connected()
+            rules: list[str] = []
+            injected = dict(self.injected_rules)
+            for window_class, title in self.windows.matcher.literal_identities():
+                identity = WindowIdentity(window_class, title, 0)
+                saved = state.get(layout, identity, connected)
+                if not isinstance(saved, Placement):
+                    continue
+                size = self.last_sizes.get(identity)
+                if not force and self.injected_rules.get(identity) == (saved, size):
+                    continue
+                monitor = self._monitor_by_name(saved.monitor)
+                selector = rule_selector(identity)
+                placement = saved
+                # Replace rather than stack the rules Hyprland already holds for this window. / 既存の規則を積み増さず置き換える。
+                rules.append(f"unset,{selector}")
+                rules.append(f"monitor {monitor.name},{selector}")
+                if size is not None:
+                    placement, target_size = self._fit_to_monitor(
+                        saved, monitor, size
+                    )
+                    rules.append(f"size {target_size[0]} {target_size[1]},{selector}")
+                rules.append(f"move {placement.x} {placement.y},{selector}")
+                injected[identity] = (saved, size)
+            if rules:
+                self.hyprland.add_window_rules(rules)
+                self.injected_rules = injected
+        except PipStateError as error:
+            log(f"cannot sync PiP window rules: {error}")
+
+    def is_tracked(self, address: str) -> bool:
+        return address in self.tracked
+
+    def ignores_title_event(self, name: str, payload: str) -> bool:
+        if name == "windowtitle":
+            return True
+        address, _, title = payload.partition(",")
+        address = "0x" + address
+        if address in self.tracked or address in self.windows.matched:
             return False
+        client = self.windows.clients.get(address)
+        return (
+            client is not None
+            and self.windows.matcher.match(client.get("class"), title) is None
+        )
 
-        if address != self.active_address:
-            self._clear_active()
-            try:
-                self._initialize(client)
-            except PipStateError as error:
-                log(f"cannot initialize PiP placement: {error}")
-                self.blocked_address = address if isinstance(address, str) else None
-                return False
-        else:
+    def save_deadline(self) -> float | None:
+        return min(
+            (
+                window.pending_since + window.debounce
+                for window in self.tracked.values()
+                if window.pending_since is not None
+            ),
+            default=None,
+        )
+
+    def flush_settled(self, now: float) -> None:
+        self._flush(
+            [
+                window
+                for window in self.tracked.values()
+                if window.pending_since is not None
+                and now >= window.pending_since + window.debounce
+            ]
+        )
+
+    def reset(self) -> None:
+        for window in self.tracked.values():
+            window.pending = None
+            window.pending_since = None
+            window.last_saved = window.last_sample
+        self.store.reset()
+        self.state = self.store.new_state()
+        self.blocked.clear()
+        if self.injected_rules:
             try:
-                self._track(client, time.monotonic())
+                self.hyprland.add_window_rules(
+                    [f"unset,{rule_selector(identity)}" for identity in self.injected_rules]
+                )
             except PipStateError as error:
-                log(f"cannot track PiP placement: {error}")
-                self._clear_active()
-                self.blocked_address = address if isinstance(address, str) else None
-                return False
-
-        return self.active_address is not None
+                log(f"cannot remove PiP window rules: {error}")
+        self.injected_rules = {}
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "layout": self.monitors.fingerprint,
+            "state": self._placements().to_json(),
+            "windows": [
+                {
+                    "address": window.address,
+                    **window.identity.to_json(),
+                    "layout": window.layout,
+                    "placement": window.last_sample.to_json(),
+                    "pending": window.pending is not None,
+                }
+                for window in self.tracked.values()
+            ],
+        }
 
     def shutdown(self) -> None:
-        self._flush_pending()
+        try:
+            self._flush(list(self.tracked.values()))
+        finally:
+            self.store.close()
+
+
+def state_directory() -> Path:
+    state_home = Path(os.environ.get("XDG_STATE_HOME", "~/.local/state")).expanduser()
+    return state_home / "hyprland"
 
 
 def state_path() -> Path:
     override = os.environ.get("PIP_WINDOW_STATE_FILE")
     if override:
         return Path(override).expanduser()
-    state_home = Path(os.environ.get("XDG_STATE_HOME", "~/.local/state")).expanduser()
-    return state_home / "hyprland" / "pip-window.json"
+    return state_directory() / "pip-window.json"
+
+
+def instance_state_path(signature: str) -> Path:
+    # Key by Wayland display, which survives restarts unlike the signature. / 再起動で変わるシグネチャでなく Wayland ディスプレイ名で区別。
+    display = signature
+    try:
+        lines = (instances_directory() / signature / "hyprland.lock").read_text(
+            encoding="utf-8"
+        ).splitlines()
+        if len(lines) > 1 and lines[1].strip():
+            display = lines[1].strip()
+    except (OSError, UnicodeDecodeError, PipStateError):
+        pass
+    return state_directory() / f"pip-window.{display}.json"
+
+
+def diagnostics_path(suffix: str, instance: str | None = None) -> Path:
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    tag = "" if instance is None else f".{instance}"
+    return (
+        state_directory() / f"pip-window-state.{stamp}.{os.getpid()}{tag}.{suffix}"
+    )
+
+
+def rules_path() -> Path:
+    override = os.environ.get("PIP_WINDOW_STATE_RULES")
+    if override:
+        return Path(override).expanduser()
+    config_home = Path(os.environ.get("XDG_CONFIG_HOME", "~/.config")).expanduser()
+    return config_home / "pip-window-state" / "rules.json"
+
+
+def store_from_environment(
+    path: Path | None = None, detect_journal: bool = False
+) -> StateStore:
+    path = path or state_path()
+    max_placements = env_int("PIP_WINDOW_STATE_MAX_PLACEMENTS", 8)
+    max_layouts = env_int("PIP_WINDOW_STATE_MAX_LAYOUTS", 8)
+    mode = os.environ.get("PIP_WINDOW_STATE_STORE", "atomic")
+    if mode not in ("atomic", "journal"):
+        raise PipStateError(
+            f"PIP_WINDOW_STATE_STORE must be 'atomic' or 'journal', got {mode!r}"
+        )
+    # The service may journal even when this shell did not set the mode. / サービスだけがジャーナルモードでも残ったジャーナルを扱う。
+    if mode == "atomic" and not (detect_journal and journal_path(path).exists()):
+        return StateStore(path, max_placements, max_layouts)
+    return JournalStateStore(
+        path,
+        max_placements,
+        max_layouts,
+        env_float("PIP_WINDOW_STATE_JOURNAL_FSYNC_INTERVAL", 5.0),
+        env_int("PIP_WINDOW_STATE_JOURNAL_MAX_BYTES", 65536),
+    )
 
 
-def event_socket_path() -> Path:
-    override = os.environ.get("PIP_WINDOW_STATE_SOCKET")
+def hyprland_socket_path(
+    override_variable: str, name: str, purpose: str, signature: str | None = None
+) -> Path:
+    override = os.environ.get(override_variable)
     if override:
         return Path(override)
 
     runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
-    signature = os.environ.get("HYPRLAND_INSTANCE_SIGNATURE")
+    signature = signature or os.environ.get("HYPRLAND_INSTANCE_SIGNATURE")
     if not runtime_dir or not signature:
         raise PipStateError(
-            "XDG_RUNTIME_DIR and HYPRLAND_INSTANCE_SIGNATURE are required for the Hyprland event socket"
+            f"XDG_RUNTIME_DIR and HYPRLAND_INSTANCE_SIGNATURE are required for the Hyprland {purpose} socket"
         )
-    return Path(runtime_dir) / "hypr" / signature / ".socket2.sock"
-
+    return Path(runtime_dir) / "hypr" / signature / name
 
-def event_name(line: str) -> str:
-    return line.split(">>", 1)[0]
 
+def control_socket_path(signature: str | None = None) -> Path:
+    return hyprland_socket_path(
+        "PIP_WINDOW_STATE_CONTROL_SOCKET",
+        ".pip-window-state.sock",
+        "control",
+        signature,
+    )
 
-def run_daemon(hyprland: Hyprland, store: StateStore) -> None:
-    poll_interval = env_float("PIP_WINDOW_STATE_POLL_INTERVAL", 0.25)
-    save_debounce = env_float("PIP_WINDOW_STATE_SAVE_DEBOUNCE", 0.5)
-    tracker = PipTracker(hyprland, store, save_debounce)
-    tracker.refresh_monitors()
 
-    socket_path = event_socket_path()
-    event_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+def control_request(command: str) -> dict[str, Any] | None:
+    try:
+        path = control_socket_path()
+    except PipStateError:
+        return None
+    chunks: list[bytes] = []
     try:
-        event_socket.connect(str(socket_path))
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(REQUEST_TIMEOUT)
+            connection.connect(str(path))
+            connection.sendall(f"{command}\n".encode("utf-8"))
+            while chunk := connection.recv(65536):
+                chunks.append(chunk)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
     except OSError as error:
-        event_socket.close()
         raise PipStateError(
-            f"cannot connect to Hyprland event socket {socket_path}: {error}"
+            f"cannot reach the PiP daemon at {path}: {error}"
         ) from error
+    try:
+        response = json.loads(b"".join(chunks))
+    except (json.JSONDecodeError, UnicodeDecodeError) as error:
+        raise PipStateError(f"PiP daemon returned invalid JSON: {error}") from error
+    if not isinstance(response, dict):
+        raise PipStateError("PiP daemon did not return a JSON object")
+    if response.pop("ok", False) is not True:
+        raise PipStateError(f"PiP daemon refused {command}: {response.get('error')}")
+    return response
+
+
+def event_socket_path(signature: str | None = None) -> Path:
+    return hyprland_socket_path(
+        "PIP_WINDOW_STATE_SOCKET", ".socket2.sock", "event", signature
+    )
 
-    def stop(_signum: int, _frame: Any) -> None:
-        raise SystemExit(0)
 
-    signal.signal(signal.SIGINT, stop)
-    signal.signal(signal.SIGTERM, stop)
+def request_socket_path(signature: str | None = None) -> Path:
+    return hyprland_socket_path(
+        "PIP_WINDOW_STATE_REQUEST_SOCKET", ".socket.sock", "request", signature
+    )
+
+
+def instances_directory() -> Path:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        raise PipStateError("XDG_RUNTIME_DIR is required to find Hyprland instances")
+    return Path(runtime_dir) / "hypr"
 
-    buffer = ""
-    active = tracker.refresh()
-    next_poll = time.monotonic() + poll_interval if active else None
 
+def running_instances() -> dict[str, float]:
+    instances: dict[str, float] = {}
     try:
-        while True:
-            timeout = (
-                None if next_poll is None else max(0.0, next_poll - time.monotonic())
-            )
-            event_socket.settimeout(timeout)
+        for entry in instances_directory().iterdir():
             try:
-                chunk = event_socket.recv(65536)
-            except socket.timeout:
-                active = tracker.refresh()
-                next_poll = time.monotonic() + poll_interval if active else None
+                instances[entry.name] = (entry / ".socket2.sock").stat().st_mtime
+            except OSError:
                 continue
+    except (OSError, PipStateError):
+        return {}
+    return instances
+
+
+def instance_refused(signature: str) -> bool:
+    # A crashed instance leaves its socket files behind; nothing accepts on them any more. / クラッシュしたインスタンスはソケットファイルだけが残り、接続を受け付けない。
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(RECONNECT_INITIAL_DELAY)
+        try:
+            client.connect(str(request_socket_path(signature)))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return True
+        except OSError:
+            return False
+    return False
+
+
+def latest_instance_signature() -> str | None:
+    instances = running_instances()
+    return max(instances, key=lambda signature: instances[signature], default=None)
+
+
+def instances_mode() -> str:
+    mode = os.environ.get("PIP_WINDOW_STATE_INSTANCES", "current")
+    if mode not in INSTANCE_MODES:
+        raise PipStateError(
+            f"PIP_WINDOW_STATE_INSTANCES must be 'current' or 'all', got {mode!r}"
+        )
+    return mode
+
+
+def hyprland_from_environment(signature: str | None = None) -> Hyprland:
+    hyprctl = os.environ.get("PIP_WINDOW_STATE_HYPRCTL", "hyprctl")
+    transport = os.environ.get("PIP_WINDOW_STATE_TRANSPORT", "socket")
+    if transport == "hyprctl":
+        hyprland = Hyprland(hyprctl)
+    elif transport != "socket":
+        raise PipStateError(
+            f"PIP_WINDOW_STATE_TRANSPORT must be 'socket' or 'hyprctl', got {transport!r}"
+        )
+    else:
+        hyprland = Hyprland(hyprctl, request_socket_path(signature))
+    if signature is not None:
+        hyprland.retarget(signature)
+    return hyprland
+
+
+class TraceRecorder:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        try:
+            self.file = path.open("w", encoding="utf-8")
+        except OSError as error:
+            raise PipStateError(f"cannot write trace {path}: {error}") from error
+        self.started = time.monotonic()
+        self.entries = 0
+
+    def write(self, **entry: str) -> None:
+        elapsed = round(time.monotonic() - self.started, 6)
+        self.file.write(json.dumps({"t": elapsed, **entry}, ensure_ascii=False) + "\n")
+        self.entries += 1
+
+    def close(self) -> None:
+        self.write()
+        self.file.close()
+        log(f"recorded {self.entries} trace entries to {self.path}")
+
+
+class LineFramer:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> list[str]:
+        buffer = self.buffer
+        buffer += chunk
+        lines: list[str] = []
+        start = 0
+        with memoryview(buffer) as view:
+            while (end := buffer.find(b"\n", start)) != -1:
+                # Legacy clients may send non-UTF-8 titles; keep the line rather than drop the socket. / 旧来のクライアントは非UTF-8のタイトルを送ることがあるため、切断せず置換して扱う。
+                lines.append(str(view[start:end], "utf-8", "replace"))
+                start = end + 1
+        del buffer[:start]
+        return lines
+
+
+def split_event(line: str) -> tuple[str, str]:
+    name, _, payload = line.partition(">>")
+    return name, payload
+
+
+def event_address(payload: str) -> str:
+    return "0x" + payload.split(",", 1)[0]
+
+
+def parse_geometry_event(payload: str) -> tuple[str, tuple[int, int], tuple[int, int]]:
+    fields = payload.split(",")
+    if len(fields) != 5:
+        raise PipStateError(f"invalid {PIP_GEOMETRY_EVENT} payload {payload!r}")
+    try:
+        x, y, width, height = (int(field) for field in fields[1:])
+    except ValueError as error:
+        raise PipStateError(
+            f"invalid {PIP_GEOMETRY_EVENT} payload {payload!r}"
+        ) from error
+    return event_address(payload), (x, y), (width, height)
+
+
+def tracking_mode() -> str:
+    mode = os.environ.get("PIP_WINDOW_STATE_TRACKING", "events")
+    if mode not in TRACKING_MODES:
+        raise PipStateError(
+            f"PIP_WINDOW_STATE_TRACKING must be one of {', '.join(TRACKING_MODES)}, got {mode!r}"
+        )
+    return mode
+
+
+class ProfileSwitch:
+    def __init__(self) -> None:
+        self.profiler: cProfile.Profile | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.profiler is not None
+
+    def toggle(self) -> None:
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            log("started profiling; send SIGUSR1 again to write the profile")
+            return
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        path = diagnostics_path("prof")
+        try:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError as error:
+            log(f"cannot write profile {path}: {error}")
+            return
+        log(f"wrote profile to {path}")
+
+
+def add_signal_handlers(
+    loop: asyncio.AbstractEventLoop,
+    stop: Callable[[], None],
+    profile: Callable[[], None],
+    snapshot: Callable[[], None],
+) -> None:
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+    loop.add_signal_handler(signal.SIGUSR1, profile)
+    loop.add_signal_handler(signal.SIGUSR2, snapshot)
+
+
+def remove_signal_handlers(loop: asyncio.AbstractEventLoop) -> None:
+    for signum in DAEMON_SIGNALS:
+        loop.remove_signal_handler(signum)
+
+
+class PipDaemon:
+    def __init__(
+        self,
+        tracker: PipTracker,
+        tracking: str,
+        event_settle: float,
+        signature: str | None = None,
+        follow: bool = False,
+        until_gone: bool = False,
+    ) -> None:
+        self.tracker = tracker
+        self.tracking = tracking
+        self.event_settle = event_settle
+        self.signature = signature
+        self.follow = follow
+        self.until_gone = until_gone
+        self.event_writer: asyncio.StreamWriter | None = None
+        self.control_server: asyncio.AbstractServer | None = None
+        self.control_path: Path | None = None
+        self.stats = EventStats()
+        self.batch = EventBatch()
+        self.recorder: TraceRecorder | None = None
+        self.cpu_started = time.process_time()
+        self.profile = ProfileSwitch()
+        self.poll_timer: asyncio.TimerHandle | None = None
+        self.save_timer: asyncio.TimerHandle | None = None
+        self.save_timer_deadline: float | None = None
+        self.sync_timer: asyncio.TimerHandle | None = None
+        self.settle_timer: asyncio.TimerHandle | None = None
+        self.stopped: asyncio.Future[None] | None = None
+
+    def _stop(self, error: BaseException | None = None) -> None:
+        if self.stopped is None or self.stopped.done():
+            return
+        if error is None:
+            self.stopped.set_result(None)
+        else:
+            self.stopped.set_exception(error)
+
+    def stop(self) -> None:
+        self._stop()
+
+    def snapshot(self) -> None:
+        self._guarded(self._dump_snapshot)
+
+    def _guarded(self, callback: Any, *arguments: Any) -> None:
+        started = time.perf_counter()
+        try:
+            callback(*arguments)
+        except HyprlandUnavailable as error:
+            log(f"lost Hyprland: {error}")
+            self._disconnect()
+        except Exception as error:
+            self._stop(error)
+        finally:
+            self.stats.blocked.record(time.perf_counter() - started)
+
+    def _call_later(
+        self, delay: float, callback: Any, *arguments: Any
+    ) -> asyncio.TimerHandle:
+        return asyncio.get_running_loop().call_later(
+            max(0.0, delay), self._guarded, callback, *arguments
+        )
+
+    def _refresh(self, resync: bool = False) -> None:
+        try:
+            active = self.tracker.refresh(resync)
+        except HyprlandUnavailable:
+            raise
+        except PipStateError as error:
+            # One bad reply must not stop the daemon; the next poll retries. / 不正な応答 1 件でデーモンを止めず次のポーリングで再試行。
+            log(f"cannot refresh PiP windows: {error}")
+            active = True
+        if self.poll_timer is not None:
+            self.poll_timer.cancel()
+        self.poll_timer = (
+            self._call_later(self.tracker.poll_schedule.interval, self._poll)
+            if active
+            else None
+        )
+        self._schedule_save()
+
+    def _poll(self) -> None:
+        self.poll_timer = None
+        self._refresh(resync=True)
+
+    def _schedule_sync(self) -> None:
+        if self.sync_timer is not None:
+            return
+        deadline = self.tracker.store.sync_deadline()
+        if deadline is not None:
+            self.sync_timer = self._call_later(
+                deadline - time.monotonic(), self._sync
+            )
+
+    def _sync(self) -> None:
+        self.sync_timer = None
+        self.tracker.store.sync()
+
+    def _schedule_save(self) -> None:
+        self._schedule_sync()
+        deadline = self.tracker.save_deadline()
+        if deadline == self.save_timer_deadline:
+            return
+        if self.save_timer is not None:
+            self.save_timer.cancel()
+        self.save_timer_deadline = deadline
+        self.save_timer = (
+            None
+            if deadline is None
+            else self._call_later(deadline - time.monotonic(), self._flush, deadline)
+        )
+
+    def _flush(self, deadline: float) -> None:
+        self.save_timer = None
+        self.save_timer_deadline = None
+        self.tracker.flush_settled(max(time.monotonic(), deadline))
+        self._schedule_save()
+
+    def _handle(self, line: str) -> None:
+        tracker = self.tracker
+        batch = self.batch
+        name, payload = split_event(line)
+        self.stats.received[name] = self.stats.received.get(name, 0) + 1
+        if name in TITLE_EVENTS and tracker.ignores_title_event(name, payload):
+            self.stats.dropped += 1
+            return
+        self.stats.processed += 1
+        if name in RELEVANT_MONITOR_EVENTS:
+            tracker.monitors.apply_event(name, payload)
+            batch.windows = True
+            batch.resync = batch.resync or name == "configreloaded"
+        elif name in WINDOW_TABLE_EVENTS:
+            if not tracker.windows.apply_event(name, payload):
+                return
+            batch.windows = True
+        elif self.tracking != "events":
+            return
+        elif name == PIP_GEOMETRY_EVENT:
+            try:
+                address, position, size = parse_geometry_event(payload)
+            except PipStateError as error:
+                log(str(error))
+                return
+            if not tracker.is_tracked(address):
+                return
+            if tracker.track_geometry(address, position, size, time.monotonic()):
+                self._schedule_save()
+                return
+            batch.windows = True
+        elif name in TRACKED_WINDOW_EVENTS and tracker.is_tracked(
+            address := event_address(payload)
+        ):
+            tracker.windows.forget_geometry(address)
+            batch.windows = True
+        else:
+            return
+        self.stats.refresh_requests += 1
 
+    def _apply_batch(self) -> None:
+        self.settle_timer = None
+        batch = self.batch
+        self.batch = EventBatch()
+        if not batch.dirty:
+            return
+        self.stats.batches += 1
+        if batch.resync:
+            self.tracker.reload_rules()
+            self.tracker.sync_window_rules(force=True)
+        self._refresh(resync=batch.resync)
+        self.stats.refreshes += 1
+
+    async def _read_events(self, reader: asyncio.StreamReader) -> None:
+        framer = LineFramer()
+        recv = PHASE_TIMINGS.setdefault("recv", LatencyHistogram())
+        decode = PHASE_TIMINGS.setdefault("decode", LatencyHistogram())
+        while True:
+            try:
+                chunk = await reader.read(65536)
+            except OSError as error:
+                log(f"cannot read Hyprland event socket: {error}")
+                return
             if not chunk:
-                raise PipStateError("Hyprland event socket closed")
+                return
+            started = time.perf_counter()
+            lines = framer.feed(chunk)
+            decode.record(time.perf_counter() - started)
+            for line in lines:
+                if self.recorder is not None:
+                    self.recorder.write(event=line)
+                try:
+                    self._handle(line)
+                except HyprlandUnavailable:
+                    raise
+                except PipStateError as error:
+                    log(f"cannot handle Hyprland event {line!r}: {error}")
+            if self.batch.dirty and self.event_settle <= 0:
+                self._apply_batch()
+            elif self.batch.dirty and self.settle_timer is None:
+                self.settle_timer = self._call_later(
+                    self.event_settle, self._apply_batch
+                )
+            elapsed = time.perf_counter() - started
+            recv.record(elapsed)
+            self.stats.blocked.record(elapsed)
+
+    def _disconnect(self) -> None:
+        if self.event_writer is not None:
+            self.event_writer.close()
+
+    def _suspend(self) -> None:
+        for timer in (self.poll_timer, self.settle_timer):
+            if timer is not None:
+                timer.cancel()
+        self.poll_timer = None
+        self.settle_timer = None
+        self.batch = EventBatch()
+
+    def _resume(self) -> None:
+        tracker = self.tracker
+        tracker.monitors.invalidate()
+        tracker.windows.invalidate()
+        tracker.reload_rules()
+        # A restarted Hyprland has forgotten the dynamic rules. / 再起動した Hyprland は動的ルールを失っている。
+        tracker.sync_window_rules(force=True)
+        self._refresh(resync=True)
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        path = event_socket_path(self.signature)
+        try:
+            reader, writer = await asyncio.open_unix_connection(str(path))
+        except OSError as error:
+            raise PipStateError(
+                f"cannot connect to Hyprland event socket {path}: {error}"
+            ) from error
+        self.event_writer = writer
+        return reader, writer
 
+    async def _reconnect(self) -> asyncio.StreamReader | None:
+        delay = RECONNECT_INITIAL_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            if self.until_gone and (
+                not event_socket_path(self.signature).exists()
+                or instance_refused(self.signature)
+            ):
+                log(f"Hyprland instance {self.signature} is gone")
+                return None
+            if self.follow:
+                signature = latest_instance_signature()
+                if signature is not None and signature != self.signature:
+                    log(f"following Hyprland instance {signature}")
+                    self.signature = signature
+                    self.tracker.hyprland.retarget(signature)
             try:
-                buffer += chunk.decode("utf-8")
-            except UnicodeDecodeError as error:
-                raise PipStateError(
-                    f"Hyprland event socket returned invalid UTF-8: {error}"
-                ) from error
+                reader, _ = await self._connect()
+            except PipStateError as error:
+                if delay == RECONNECT_INITIAL_DELAY:
+                    log(f"{error}; retrying with backoff up to {RECONNECT_MAX_DELAY:g}s")
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            return reader
+
+    async def _follow_events(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            try:
+                await self._read_events(reader)
+            except HyprlandUnavailable as error:
+                log(f"lost Hyprland: {error}")
+            if self.event_writer is not None:
+                self.event_writer.close()
+            self._suspend()
+            lost = time.monotonic()
+            log("Hyprland event socket closed; reconnecting")
+            next_reader = await self._reconnect()
+            if next_reader is None:
+                return
+            reader = next_reader
+            self.stats.reconnects += 1
+            try:
+                await self._listen_control()
+            except PipStateError as error:
+                log(str(error))
+            self._guarded(self._resume)
+            log(f"reconnected to Hyprland after {time.monotonic() - lost:.2f}s")
+
+    async def _listen_control(self) -> None:
+        path = control_socket_path(self.signature)
+        if path == self.control_path:
+            return
+        self._close_control()
+        try:
+            path.unlink(missing_ok=True)
+            self.control_server = await asyncio.start_unix_server(
+                self._serve_control, path=str(path)
+            )
+            path.chmod(0o600)
+        except OSError as error:
+            raise PipStateError(
+                f"cannot listen on control socket {path}: {error}"
+            ) from error
+        self.control_path = path
+
+    def _close_control(self) -> None:
+        if self.control_server is not None:
+            self.control_server.close()
+            self.control_server = None
+        if self.control_path is not None:
+            self.control_path.unlink(missing_ok=True)
+            self.control_path = None
+
+    def _dump_snapshot(self) -> None:
+        snapshot = {
+            "captured_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "profiling": self.profile.active,
+            "tracker": self.tracker.status(),
+            "statistics": self._statistics(),
+            "phases": {
+                phase: histogram.to_json()
+                for phase, histogram in sorted(PHASE_TIMINGS.items())
+            },
+            "slowest_calls": self.tracker.hyprland.slowest_calls(),
+        }
+        path = diagnostics_path("json", self.signature if self.until_gone else None)
+        try:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            path.write_text(
+                json.dumps(snapshot, ensure_ascii=False, indent=2, sort_keys=True)
+                + "\n",
+                encoding="utf-8",
+            )
+        except OSError as error:
+            log(f"cannot write snapshot {path}: {error}")
+            return
+        log(f"wrote snapshot to {path}")
+
+    def _reset(self) -> dict[str, Any]:
+        if self.save_timer is not None:
+            self.save_timer.cancel()
+        self.save_timer = None
+        self.save_timer_deadline = None
+        self.tracker.reset()
+        log("reset PiP position and width state on request")
+        return {"path": str(self.tracker.store.path)}
+
+    def _statistics(self) -> dict[str, Any]:
+        tracker = self.tracker
+        return {
+            "events": self.stats.to_json(),
+            "hyprland": {
+                kind: histogram.to_json()
+                for kind, histogram in sorted(tracker.hyprland.calls.items())
+            },
+            "monitor_queries": tracker.monitors.refreshes,
+            "saves": {
+                "performed": tracker.store.writes,
+                "skipped": tracker.store.skipped_writes,
+            },
+            "poll_interval": tracker.poll_schedule.interval,
+            "cpu_seconds": time.process_time() - self.cpu_started,
+        }
+
+    def _control(self, command: str) -> dict[str, Any]:
+        if command == "status":
+            return self.tracker.status()
+        if command == "reset":
+            return self._reset()
+        if command == "stats":
+            return self._statistics()
+        raise PipStateError(f"unknown control command {command!r}")
+
+    async def _serve_control(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            started = time.perf_counter()
+            try:
+                response = {"ok": True, **self._control(line.decode("utf-8").strip())}
+            except (PipStateError, UnicodeDecodeError) as error:
+                response = {"ok": False, "error": str(error)}
+            self.stats.blocked.record(time.perf_counter() - started)
+            writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8"))
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        add_signal_handlers(
+            loop,
+            self._stop,
+            functools.partial(self._guarded, self.profile.toggle),
+            self.snapshot,
+        )
+        try:
+            await self.serve()
+        finally:
+            remove_signal_handlers(loop)
+            if self.profile.active:
+                self.profile.toggle()
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        assert self.stopped is not None
+        reader, writer = await self._connect()
+        try:
+            await self._listen_control()
+        except PipStateError:
+            writer.close()
+            raise
 
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                name = event_name(line)
-                if name in RELEVANT_MONITOR_EVENTS:
-                    tracker.refresh_monitors()
-                if name in RELEVANT_MONITOR_EVENTS or name in RELEVANT_WINDOW_EVENTS:
-                    active = tracker.refresh()
-                    next_poll = time.monotonic() + poll_interval if active else None
+        def reader_done(task: asyncio.Task[None]) -> None:
+            if not task.cancelled():
+                self._stop(task.exception())
+
+        reader_task = loop.create_task(self._follow_events(reader))
+        reader_task.add_done_callback(reader_done)
+        try:
+            self._guarded(self._refresh)
+            await self.stopped
+        finally:
+            reader_task.cancel()
+            for timer in (
+                self.poll_timer,
+                self.save_timer,
+                self.settle_timer,
+                self.sync_timer,
+            ):
+                if timer is not None:
+                    timer.cancel()
+            self._disconnect()
+            self._close_control()
+            self.tracker.shutdown()
+            log(self.stats.summary())
+            log(self.tracker.store.write_summary())
+            log(f"queried monitors {self.tracker.monitors.refreshes} times")
+
+
+def daemon_for_instance(
+    hyprland: Hyprland,
+    store: StateStore,
+    signature: str | None,
+    follow: bool,
+    until_gone: bool = False,
+    time_scale: float = 1.0,
+) -> PipDaemon:
+    tracking = tracking_mode()
+    fast_poll_interval = env_float("PIP_WINDOW_STATE_POLL_INTERVAL_FAST", 0.05)
+    if tracking == "events":
+        ceiling = env_float("PIP_WINDOW_STATE_SAFETY_POLL_INTERVAL", 30.0)
+        initial = ceiling
+    else:
+        initial = env_float("PIP_WINDOW_STATE_POLL_INTERVAL", 0.25)
+        ceiling = env_float("PIP_WINDOW_STATE_POLL_INTERVAL_MAX", max(2.0, initial))
+    idle_samples = env_int("PIP_WINDOW_STATE_POLL_IDLE_SAMPLES", 4)
+    # Only replays run the daemon's clocks faster. / デーモンの時計を速めるのはリプレイだけ。
+    poll_schedule = PollSchedule(
+        initial / time_scale,
+        fast_poll_interval / time_scale,
+        ceiling / time_scale,
+        idle_samples,
+    )
+    save_debounce = env_float("PIP_WINDOW_STATE_SAVE_DEBOUNCE", 0.5) / time_scale
+    event_settle = (
+        env_float("PIP_WINDOW_STATE_EVENT_SETTLE", 0.0, allow_zero=True) / time_scale
+    )
+    tracker = PipTracker(
+        hyprland, store, save_debounce, poll_schedule, rules_path()
+    )
+    daemon = PipDaemon(
+        tracker,
+        tracking,
+        event_settle,
+        signature=signature,
+        follow=follow,
+        until_gone=until_gone,
+    )
+    tracker.monitors.refresh()
+    tracker.sync_window_rules()
+    return daemon
+
+
+def run_daemon(
+    hyprland: Hyprland,
+    store: StateStore,
+    recorder: TraceRecorder | None = None,
+    time_scale: float = 1.0,
+) -> None:
+    hyprland.recorder = recorder
+    try:
+        daemon = daemon_for_instance(
+            hyprland,
+            store,
+            os.environ.get("HYPRLAND_INSTANCE_SIGNATURE"),
+            follow=not os.environ.get("PIP_WINDOW_STATE_SOCKET"),
+            time_scale=time_scale,
+        )
+        daemon.recorder = recorder
+        asyncio.run(daemon.run())
     finally:
-        event_socket.close()
-        tracker.shutdown()
+        if recorder is not None:
+            recorder.close()
+
+
+class InstanceSupervisor:
+    def __init__(self, discovery_interval: float) -> None:
+        self.discovery_interval = discovery_interval
+        self.daemons: dict[str, PipDaemon] = {}
+        self.tasks: dict[str, asyncio.Task[None]] = {}
+        self.failed: set[str] = set()
+        self.unavailable: dict[str, int] = {}
+        self.profile = ProfileSwitch()
+        self.stopped: asyncio.Future[None] | None = None
+
+    def _stop(self) -> None:
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def _snapshot(self) -> None:
+        for daemon in self.daemons.values():
+            daemon.snapshot()
+
+    def _start(self, signature: str) -> None:
+        try:
+            store = store_from_environment(instance_state_path(signature))
+            daemon = daemon_for_instance(
+                hyprland_from_environment(signature),
+                store,
+                signature,
+                follow=False,
+                until_gone=True,
+            )
+        except HyprlandUnavailable as error:
+            self._unavailable(signature, str(error))
+            return
+        except PipStateError as error:
+            log(f"cannot serve Hyprland instance {signature}: {error}")
+            self.failed.add(signature)
+            return
+        self.unavailable.pop(signature, None)
+        daemon.profile = self.profile
+        daemon.stopped = asyncio.get_running_loop().create_future()
+        task = asyncio.get_running_loop().create_task(daemon.serve())
+        task.add_done_callback(functools.partial(self._finished, signature))
+        self.daemons[signature] = daemon
+        self.tasks[signature] = task
+        log(f"serving Hyprland instance {signature} with {store.path}")
+
+    def _unavailable(self, signature: str, reason: str) -> None:
+        # Sockets of a starting instance may not accept yet; give up after a few scans so stale ones stay quiet. / 起動直後は未応答のことがあるため数回だけ再試行し、残骸は黙って無視する。
+        attempts = self.unavailable.get(signature, 0) + 1
+        if attempts == 1:
+            log(f"Hyprland instance {signature} is not ready: {reason}")
+        if attempts < STALE_INSTANCE_SCANS:
+            self.unavailable[signature] = attempts
+            return
+        log(f"ignoring stale Hyprland instance {signature} after {attempts} scans")
+        self.unavailable.pop(signature, None)
+        self.failed.add(signature)
+
+    def _finished(self, signature: str, task: asyncio.Task[None]) -> None:
+        self.daemons.pop(signature, None)
+        self.tasks.pop(signature, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            log(f"stopped serving Hyprland instance {signature}")
+            return
+        log(f"stopped serving Hyprland instance {signature}: {error}")
+        self.failed.add(signature)
+
+    def _discover(self) -> None:
+        running = running_instances()
+        self.failed &= running.keys()
+        self.unavailable = {
+            signature: attempts
+            for signature, attempts in self.unavailable.items()
+            if signature in running
+        }
+        for signature in sorted(running, key=lambda signature: running[signature]):
+            if signature in self.daemons or signature in self.failed:
+                continue
+            if instance_refused(signature):
+                self._unavailable(signature, "its request socket refuses connections")
+                continue
+            self._start(signature)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        add_signal_handlers(loop, self._stop, self.profile.toggle, self._snapshot)
+        try:
+            while not self.stopped.done():
+                self._discover()
+                await asyncio.wait((self.stopped,), timeout=self.discovery_interval)
+        finally:
+            remove_signal_handlers(loop)
+            for daemon in self.daemons.values():
+                daemon.stop()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+            if self.profile.active:
+                self.profile.toggle()
+
+
+def run_supervisor() -> None:
+    for variable in (
+        "PIP_WINDOW_STATE_FILE",
+        "PIP_WINDOW_STATE_SOCKET",
+        "PIP_WINDOW_STATE_REQUEST_SOCKET",
+        "PIP_WINDOW_STATE_CONTROL_SOCKET",
+    ):
+        if os.environ.get(variable):
+            raise PipStateError(
+                f"{variable} cannot be combined with PIP_WINDOW_STATE_INSTANCES=all"
+            )
+    instances_directory()
+    supervisor = InstanceSupervisor(
+        env_float("PIP_WINDOW_STATE_DISCOVERY_INTERVAL", 2.0)
+    )
+    asyncio.run(supervisor.run())
+
+
+def benchmark_framing(bursts: int = 256, burst_size: int = 65536) -> None:
+    sample = (
+        "windowtitlev2>>55d0c0ffee00,ピクチャー イン ピクチャー\n"
+        "activewindowv2>>55d0c0ffee00\n"
+        "movewindowv2>>55d0c0ffee00,3,3\n"
+    ).encode("utf-8")
+    chunk_size = burst_size - 1
+    # Odd-sized bursts split lines and multibyte characters across reads. / 奇数長のバーストで行とマルチバイト文字を読み込み境界で分割。
+    stream = sample * chunk_size
+    chunks = [
+        stream[offset : offset + chunk_size]
+        for offset in range(0, len(stream), chunk_size)
+    ]
+    framer = LineFramer()
+    lines = 0
+    fed = 0
+    started = time.perf_counter()
+    for index in range(bursts):
+        chunk = chunks[index % len(chunks)]
+        lines += len(framer.feed(chunk))
+        fed += len(chunk)
+    elapsed = time.perf_counter() - started
+    print(
+        f"framed {lines} lines from {bursts} bursts of {chunk_size} bytes "
+        f"in {elapsed:.3f}s ({fed / elapsed / 1_000_000:.1f} MB/s, "
+        f"{elapsed / max(lines, 1) * 1_000_000_000:.0f} ns/line)"
+    )
+
+
+@dataclass
+class Trace:
+    events: list[tuple[float, str]]
+    responses: dict[str, tuple[list[float], list[str]]]
+    duration: float
+
+    def response(self, request: str, elapsed: float) -> str:
+        recorded = self.responses.get(request)
+        if recorded is None:
+            if request.startswith("[[BATCH]]"):
+                return "\n\n".join("ok" for _ in request[9:].split(";"))
+            return "unknown request"
+        times, bodies = recorded
+        return bodies[max(0, bisect.bisect_right(times, elapsed) - 1)]
+
+
+def load_trace(path: Path) -> Trace:
+    try:
+        lines = path.read_text(encoding="utf-8").splitlines()
+    except (OSError, UnicodeDecodeError) as error:
+        raise PipStateError(f"cannot read trace {path}: {error}") from error
+    trace = Trace([], {}, 0.0)
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError as error:
+            raise PipStateError(f"invalid JSON in trace {path}:{number}: {error}") from error
+        elapsed = entry.get("t") if isinstance(entry, dict) else None
+        if (
+            isinstance(elapsed, bool)
+            or not isinstance(elapsed, (int, float))
+            or not math.isfinite(elapsed)
+            or elapsed < 0
+        ):
+            raise PipStateError(f"trace {path}:{number} has an invalid timestamp")
+        trace.duration = max(trace.duration, float(elapsed))
+        if isinstance(entry.get("event"), str):
+            trace.events.append((float(elapsed), entry["event"]))
+        elif isinstance(entry.get("request"), str) and isinstance(
+            entry.get("response"), str
+        ):
+            times, bodies = trace.responses.setdefault(entry["request"], ([], []))
+            times.append(float(elapsed))
+            bodies.append(entry["response"])
+    trace.events.sort(key=lambda event: event[0])
+    return trace
+
+
+class TraceReplay:
+    def __init__(self, trace: Trace, speed: float, directory: Path) -> None:
+        self.trace = trace
+        self.speed = speed
+        self.directory = directory
+        self.control_path = directory / "control.sock"
+        self.event_writer: asyncio.StreamWriter | None = None
+        self.connected = asyncio.Event()
+        self.started = 0.0
+        self.late_events = 0
+
+    def _elapsed(self) -> float:
+        if not self.connected.is_set():
+            return 0.0
+        return (time.monotonic() - self.started) * self.speed
+
+    async def _serve_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = (await reader.read(65536)).decode("utf-8")
+            response = self.trace.response(request, self._elapsed())
+            writer.write(response.encode("utf-8"))
+            await writer.drain()
+        except (OSError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_events(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        if self.connected.is_set():
+            return
+        # The trace clock starts when the daemon listens, not when Python starts. / トレースの時計はインタプリタ起動ではなく接続時点から進める。
+        self.started = time.monotonic()
+        self.event_writer = writer
+        self.connected.set()
+
+    async def _statistics(self) -> dict[str, Any]:
+        reader, writer = await asyncio.open_unix_connection(str(self.control_path))
+        try:
+            writer.write(b"stats\n")
+            await writer.drain()
+            return json.loads(await reader.read())
+        finally:
+            writer.close()
+
+    async def run(self) -> tuple[dict[str, Any], float]:
+        request_path = self.directory / "request.sock"
+        event_path = self.directory / "event.sock"
+        log_path = self.directory / "daemon.log"
+        request_server = await asyncio.start_unix_server(
+            self._serve_request, path=str(request_path)
+        )
+        event_server = await asyncio.start_unix_server(
+            self._serve_events, path=str(event_path)
+        )
+        environment = dict(
+            os.environ,
+            PIP_WINDOW_STATE_CONTROL_SOCKET=str(self.control_path),
+            PIP_WINDOW_STATE_FILE=str(self.directory / "state.json"),
+            PIP_WINDOW_STATE_INSTANCES="current",
+            PIP_WINDOW_STATE_REQUEST_SOCKET=str(request_path),
+            PIP_WINDOW_STATE_SOCKET=str(event_path),
+            PIP_WINDOW_STATE_TRANSPORT="socket",
+        )
+        environment.setdefault(
+            "PIP_WINDOW_STATE_RULES", str(self.directory / "rules.json")
+        )
+        with log_path.open("wb") as daemon_log:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                str(Path(__file__).resolve()),
+                "daemon",
+                "--time-scale",
+                repr(self.speed),
+                env=environment,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=daemon_log,
+                stderr=daemon_log,
+            )
+        try:
+            await asyncio.wait_for(self.connected.wait(), REQUEST_TIMEOUT)
+            assert self.event_writer is not None
+            for elapsed, line in self.trace.events:
+                delay = elapsed / self.speed - (time.monotonic() - self.started)
+                if delay > 0:
+                    await self.event_writer.drain()
+                    await asyncio.sleep(delay)
+                elif delay < -LATE_EVENT_TOLERANCE:
+                    self.late_events += 1
+                self.event_writer.write(line.encode("utf-8") + b"\n")
+            await self.event_writer.drain()
+            remaining = self.trace.duration / self.speed - (
+                time.monotonic() - self.started
+            )
+            # Give the last debounced save a chance to land. / 最後のデバウンス保存が終わるのを待つ。
+            await asyncio.sleep(max(remaining, 0.0) + 1.0)
+            statistics = await self._statistics()
+            wall = time.monotonic() - self.started
+        except (OSError, asyncio.TimeoutError, json.JSONDecodeError) as error:
+            detail = log_path.read_text(encoding="utf-8", errors="replace").strip()
+            raise PipStateError(
+                f"replay failed: {error or type(error).__name__}\n{detail}"
+            ) from error
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            await process.wait()
+            request_server.close()
+            event_server.close()
+        if statistics.pop("ok", False) is not True:
+            raise PipStateError(f"PiP daemon refused stats: {statistics.get('error')}")
+        return statistics, wall
+
+
+def replay_traces(paths: list[Path], speed: float) -> None:
+    if not math.isfinite(speed) or speed <= 0:
+        raise PipStateError(f"--speed must be greater than zero, got {speed}")
+    for path in paths:
+        trace = load_trace(path)
+        with tempfile.TemporaryDirectory(prefix="pip-replay.") as directory:
+            replay = TraceReplay(trace, speed, Path(directory))
+            statistics, wall = asyncio.run(replay.run())
+        events = sum(statistics["events"]["received"].values())
+        requests = sum(
+            histogram["count"] for histogram in statistics["hyprland"].values()
+        )
+        cpu = statistics["cpu_seconds"]
+        minutes = wall * speed / 60
+        print(
+            f"{path.stem}: {events} events over {trace.duration:.1f}s of trace "
+            f"in {wall:.1f}s; CPU {cpu * 1000:.1f} ms "
+            f"({cpu / max(events, 1) * 1_000_000:.0f} us/event); "
+            f"{requests / minutes:.1f} Hyprland requests/min; "
+            f"{statistics['saves']['performed']} saves, "
+            f"{statistics['saves']['skipped']} skipped"
+        )
+        if replay.late_events:
+            log(
+                f"{path.stem}: {replay.late_events} events were sent more than "
+                f"{LATE_EVENT_TOLERANCE * 1000:.0f} ms behind schedule; lower --speed"
+            )
 
 
 def parse_args() -> argparse.Namespace:
@@ -570,29 +2982,72 @@ def parse_args() -> argparse.Namespace:
         description="Persist the position and width of the Hyprland browser PiP window."
     )
     parser.add_argument(
-        "command", choices=("daemon", "status", "reset"), nargs="?", default="daemon"
+        "command",
+        choices=("daemon", *CONTROL_COMMANDS, "record", "replay", "bench-framing"),
+        nargs="?",
+        default="daemon",
+    )
+    parser.add_argument(
+        "traces",
+        nargs="*",
+        type=Path,
+        help="trace file to record into, or trace files to replay",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed multiplier (default: real time)",
     )
-    return parser.parse_args()
+    parser.add_argument("--time-scale", type=float, default=1.0, help=argparse.SUPPRESS)
+    # Options may follow or precede the trace files. / オプションはトレースファイルの前後どちらにも置ける。
+    args = parser.parse_intermixed_args()
+    if args.command == "record" and len(args.traces) != 1:
+        parser.error("record needs exactly one trace file")
+    if args.command == "replay" and not args.traces:
+        parser.error("replay needs at least one trace file")
+    if args.command not in ("record", "replay") and args.traces:
+        parser.error(f"{args.command} does not take trace files")
+    if args.time_scale != 1.0 and args.command != "daemon":
+        parser.error("--time-scale is only used by replayed daemons")
+    if not math.isfinite(args.time_scale) or args.time_scale <= 0:
+        parser.error(f"--time-scale must be greater than zero, got {args.time_scale}")
+    return args
 
 
 def main() -> int:
     args = parse_args()
-    store = StateStore(state_path())
-
-    if args.command == "status":
-        print(
-            json.dumps(
-                store.load().to_json(), ensure_ascii=False, indent=2, sort_keys=True
-            )
-        )
+    signature = os.environ.get("HYPRLAND_INSTANCE_SIGNATURE")
+    path = None
+    if instances_mode() == "all" and signature:
+        path = instance_state_path(signature)
+    store = store_from_environment(path, args.command in CONTROL_COMMANDS)
+
+    if args.command in CONTROL_COMMANDS:
+        response = control_request(args.command)
+        if args.command == "reset":
+            if response is None:
+                store.reset()
+            print(f"removed PiP position and width state: {store.path}")
+            return 0
+        if response is None:
+            if args.command == "stats":
+                raise PipStateError("the PiP daemon is not running")
+            response = store.load().to_json()
+        print(json.dumps(response, ensure_ascii=False, indent=2, sort_keys=True))
         return 0
-    if args.command == "reset":
-        store.reset()
-        print(f"removed PiP position and width state: {store.path}")
+    if args.command == "bench-framing":
+        benchmark_framing()
+        return 0
+    if args.command == "replay":
+        replay_traces(args.traces, args.speed)
         return 0
 
-    hyprctl = os.environ.get("PIP_WINDOW_STATE_HYPRCTL", "hyprctl")
-    run_daemon(Hyprland(hyprctl), store)
+    if args.command == "daemon" and instances_mode() == "all":
+        run_supervisor()
+        return 0
+    recorder = TraceRecorder(args.traces[0]) if args.command == "record" else None
+    run_daemon(hyprland_from_environment(), store, recorder, args.time_scale)
     return 0
 
 
@@ -12,7 +12,7 @@
 
 stdenv.mkDerivation {
   pname = "hyprland-pip-drag";
-  version = "1.1.0";
+  version = "1.2.0";
 
   src = ./.;
 
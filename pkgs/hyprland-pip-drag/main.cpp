@@ -1,10 +1,14 @@
 #include <hyprland/src/Compositor.hpp>
 #include <hyprland/src/desktop/Window.hpp>
+#include <hyprland/src/managers/EventManager.hpp>
 #include <hyprland/src/managers/KeybindManager.hpp>
 #include <hyprland/src/managers/input/InputManager.hpp>
 #include <hyprland/src/plugins/PluginAPI.hpp>
 
 #include <any>
+#include <cmath>
+#include <cstdint>
+#include <format>
 #include <linux/input-event-codes.h>
 #include <stdexcept>
 #include <string>
@@ -26,9 +30,27 @@ void stopPipDrag() {
     draggingPip = false;
 }
 
+// Report the settled geometry so pip-window-state does not have to poll clients. / pip-window-state がクライアント一覧をポーリングせずに済むよう確定した位置とサイズを通知。
+void postPipGeometry(const PHLWINDOW& window) {
+    const auto position = window->m_realPosition->goal();
+    const auto size     = window->m_realSize->goal();
+    g_pEventManager->postEvent(SHyprIPCEvent{
+        "pipwindowmoved",
+        std::format("{:x},{},{},{},{}", reinterpret_cast<uintptr_t>(window.get()), std::lround(position.x), std::lround(position.y), std::lround(size.x),
+                    std::lround(size.y)),
+    });
+}
+
 void onMouseButton(void*, SCallbackInfo& info, std::any data) {
     const auto event = std::any_cast<IPointer::SButtonEvent>(data);
 
+    if (event.state == WL_POINTER_BUTTON_STATE_RELEASED && !draggingPip && g_pInputManager->m_dragMode != MBIND_INVALID) {
+        const auto dragged = g_pInputManager->m_currentlyDraggedWindow.lock();
+        if (isBrowserPip(dragged))
+            postPipGeometry(dragged);
+        return;
+    }
+
     if (event.button != BTN_RIGHT)
         return;
 
@@ -36,7 +58,10 @@ void onMouseButton(void*, SCallbackInfo& info, std::any data) {
         if (!draggingPip)
             return;
 
+        const auto dragged = g_pInputManager->m_currentlyDraggedWindow.lock();
         stopPipDrag();
+        if (isBrowserPip(dragged))
+            postPipGeometry(dragged);
         info.cancelled = true;
         return;
     }
@@ -84,7 +109,7 @@ APICALL EXPORT PLUGIN_DESCRIPTION_INFO PLUGIN_INIT(HANDLE handle) {
         "hyprland-pip-drag",
         "Move browser PiP with right drag and resize it at its current aspect ratio with Alt+right drag",
         "purplehaze",
-        "1.1.0",
+        "1.2.0",
     };
 }
 